@@ -0,0 +1,72 @@
+//Decodes compact animations (sent by the engine as {"animation": chunk} messages) back into lists of frames.
+//See animation_codec.py for the format.
+
+//A packed change is a little-endian uint32 of (cell index << CODE_BITS | code)
+const CODE_BITS = 3;
+
+function _base64Bytes(text) {
+  const binary = atob(text);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+}
+
+class AnimationDecoder {
+  constructor() {
+    //A dictionary where the keys are animation ids and the values are the decoding state of that animation
+    this.animations = {}
+  }
+
+  //Adds a chunk of an animation. Returns the frames of the animation if this was its last chunk, and null otherwise.
+  add(chunk) {
+    let animation = this.animations[chunk.id]
+    if ("initial" in chunk) {
+      animation = {
+        packed: chunk.encoding === "packed",
+        width: chunk.width,
+        names: [...chunk.names, null],
+        codes: chunk.encoding === "packed" ? _base64Bytes(chunk.initial) : Uint8Array.from(chunk.initial),
+        frames: []
+      }
+      animation.frames.push(this._frame(animation))
+      this.animations[chunk.id] = animation
+    }
+
+    if (animation) {
+      for (let delta of chunk.deltas) {
+        if (animation.packed) {
+          const bytes = _base64Bytes(delta);
+          const view = new DataView(bytes.buffer);
+          for (let i = 0; i < bytes.length; i += 4) {
+            const change = view.getUint32(i, true);
+            animation.codes[change >>> CODE_BITS] = change & ((1 << CODE_BITS) - 1);
+          }
+        } else {
+          for (let i = 0; i < delta.length; i += 2) {
+            animation.codes[delta[i]] = delta[i + 1];
+          }
+        }
+        animation.frames.push(this._frame(animation))
+      }
+    }
+
+    if (chunk.end) {
+      delete this.animations[chunk.id]
+      return animation ? animation.frames : []
+    }
+    return null
+  }
+
+  //Builds a height x width frame of piece names (or null for empty cells) from the current codes of an animation
+  _frame(animation) {
+    let frame = []
+    for (let start = 0; start < animation.codes.length; start += animation.width) {
+      frame.push(Array.from(animation.codes.subarray(start, start + animation.width), (code) => animation.names[code]))
+    }
+    return frame
+  }
+}
+
+module.exports = { AnimationDecoder }
@@ -0,0 +1,42 @@
+import queue
+import threading
+from collections.abc import Callable
+from tetris_env import Board
+from utils import log
+
+# Builds and sends the animations of solutions on a background thread, so that the search never waits for them.
+# Requests are handled in order. Each one can be given a key, so that all of the pending requests with that key can be dropped at once.
+class AnimationBuilder:
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.dropped_keys = set()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    # Queues the animation of the placements on orig_board (built by the agent, in its animation format) to be given to send_animation
+    def submit(self, agent, orig_board: Board, placements: list, send_animation: Callable, key=None):
+        self.requests.put((agent, orig_board.copy(), placements, send_animation, key))
+
+    # Drops the pending requests with the given key (until forget is called for it)
+    def drop(self, key):
+        self.dropped_keys.add(key)
+
+    def forget(self, key):
+        self.dropped_keys.discard(key)
+
+    # Waits until every queued request has been sent or dropped
+    def wait(self):
+        self.requests.join()
+
+    def _run(self):
+        while True:
+            agent, orig_board, placements, send_animation, key = self.requests.get()
+            try:
+                if key is None or key not in self.dropped_keys:
+                    send_animation(agent.build_animation_from_placements(orig_board, placements))
+            except BrokenPipeError:
+                # Nothing is reading the animations anymore
+                pass
+            except Exception as e:
+                log(f"Could not build animation: {e!r}")
+            finally:
+                self.requests.task_done()
@@ -0,0 +1,76 @@
+import base64
+import numpy as np
+from collections.abc import Iterable
+from tetris_env import Board, piece_names
+
+# Animation formats: "frames" is a full list of piece names (or None) for every cell of every frame.
+# The compact formats send the first frame, then only the cells that change in each later frame:
+#   "delta" encodes these as JSON lists of numbers, and "packed" encodes them as base64 strings of binary numbers.
+ANIMATION_FORMATS = ("frames", "delta", "packed")
+
+# Each cell of a frame is encoded as the id of the piece filling it, or EMPTY_CODE if it is empty
+EMPTY_CODE = len(piece_names)
+
+# A packed change is a little-endian uint32 of (cell index << CODE_BITS | code)
+CODE_BITS = 3
+
+# Returns the codes of the cells of a frame of the board, in row-major order (the same order as get_frame)
+def frame_codes(board: Board):
+    return np.where(board.piece_ids.T < 0, EMPTY_CODE, board.piece_ids.T).astype(np.uint8).ravel()
+
+# Encodes the frames given by a sequence of boards as a series of chunks (dictionaries), each holding up to chunk_size frames.
+# The first chunk holds the size of the frames, the names of the codes, and the first frame (as "initial").
+# Every chunk holds a list of "deltas" (one per later frame), and the last one is marked with "end".
+# The boards are read as they are yielded, so the first chunks can be sent before the rest of the animation is built.
+def encode_animation(boards: Iterable[Board], packed=False, chunk_size=None):
+    chunk = None
+    previous = None
+    for board in boards:
+        codes = frame_codes(board)
+        if previous is None:
+            chunk = {
+                "encoding": "packed" if packed else "delta",
+                "width": board.shape[0],
+                "height": board.shape[1],
+                "names": piece_names,
+                "initial": base64.b64encode(codes.tobytes()).decode() if packed else codes.tolist(),
+                "deltas": [],
+            }
+        else:
+            changed = np.flatnonzero(codes != previous)
+            if packed:
+                changes = (changed.astype(np.uint32) << CODE_BITS | codes[changed]).astype("<u4")
+                chunk["deltas"].append(base64.b64encode(changes.tobytes()).decode())
+            else:
+                chunk["deltas"].append(np.column_stack((changed, codes[changed])).ravel().tolist())
+            if chunk_size is not None and len(chunk["deltas"]) >= chunk_size:
+                yield chunk
+                chunk = {"deltas": []}
+        previous = codes
+
+    if chunk is None:
+        chunk = {"deltas": []}
+    chunk["end"] = True
+    yield chunk
+
+# Decodes the chunks of an animation from encode_animation back into a list of frames (as given by get_frame)
+def decode_animation(chunks: Iterable[dict]):
+    frames = []
+    codes = None
+    for chunk in chunks:
+        if "initial" in chunk:
+            packed = chunk["encoding"] == "packed"
+            width, height = chunk["width"], chunk["height"]
+            names = np.array([*chunk["names"], None], dtype="object")
+            initial = chunk["initial"]
+            codes = np.frombuffer(base64.b64decode(initial), dtype=np.uint8).copy() if packed else np.array(initial, dtype=np.uint8)
+            frames.append(names[codes].reshape(height, width).tolist())
+        for delta in chunk["deltas"]:
+            if packed:
+                changes = np.frombuffer(base64.b64decode(delta), dtype="<u4")
+                codes[changes >> CODE_BITS] = changes & ((1 << CODE_BITS) - 1)
+            else:
+                changes = np.array(delta, dtype=np.int64).reshape(-1, 2)
+                codes[changes[:, 0]] = changes[:, 1]
+            frames.append(names[codes].reshape(height, width).tolist())
+    return frames
@@ -0,0 +1,113 @@
+import time
+from collections.abc import Callable
+from tetris_env import Board, count_false_negatives
+from tetris_agent import TetrisAgent
+from tetris_search import SearchEngine
+from parallel_search import run_parallel
+
+# Tracks the best approximation found by a search, for a job's anytime mode:
+#   the placements reaching the board with the fewest errors (false positives plus unfilled false negatives).
+# Once the budget (of seconds, of expanded nodes, or of both) runs out without an exact solution having been found,
+#   the best approximation so far is given to on_approximation, and then every better one is given to it as soon as it is offered.
+# Nothing more is given to it once an exact solution is found.
+class AnytimeTracker:
+    def __init__(self, on_approximation: Callable[[list], None], budget_seconds: float = None, budget_nodes: int = None):
+        if budget_seconds is None and budget_nodes is None:
+            raise ValueError("Anytime mode needs a budget of seconds or nodes")
+        self.on_approximation = on_approximation
+        self.deadline = None if budget_seconds is None else time.monotonic() + budget_seconds
+        self.budget_nodes = budget_nodes
+        self.best_errors = None
+        self.best_placements = None
+        self.sent_errors = None
+        self.solved = False
+        self.ended = False
+
+    # Offers the placements reaching a board with the given number of errors, which are kept if they are the best so far
+    def offer(self, errors, placements: list):
+        if self.best_errors is None or errors < self.best_errors:
+            self.best_errors = errors
+            self.best_placements = placements
+
+    def expired(self, num_nodes=0):
+        return self.ended or (self.deadline is not None and time.monotonic() >= self.deadline) or (self.budget_nodes is not None and num_nodes >= self.budget_nodes)
+
+    # Ends the budget early (when the exact search is over before it runs out)
+    def end(self):
+        self.ended = True
+
+    # Gives the best approximation to on_approximation if the budget has run out and it has not been given already
+    def check(self, num_nodes=0):
+        if self.expired(num_nodes):
+            self.finish()
+
+    # Gives the best approximation to on_approximation (whether or not the budget has run out) if it has not been given already
+    def finish(self):
+        if self.solved or self.best_placements is None or self.best_errors == self.sent_errors:
+            return
+        self.sent_errors = self.best_errors
+        self.on_approximation(self.best_placements)
+
+# Returns the allowance of false negatives that the agents of a job in anytime mode prune with: the job's own until its budget runs out
+#   (or once it has an exact solution), and afterwards a relaxed one, so that the search goes on past the boards that the exact search gives up on.
+# The relaxed allowance only prunes boards that cannot end up with fewer errors than the best approximation: such a board would need
+#   fewer false negatives than the best approximation's errors, even with no false positives (since a node may not have used any of its allowance yet).
+# It is lowered as better approximations are found, but never below the job's own, so solutions (which still need the job's own allowance,
+#   see SearchEngine.allowable_false_negatives) are never pruned. The transposition table only records the boards whose subtrees have no solutions,
+#   which does not depend on the allowance the agent prunes with, so it stays valid throughout (though the approximations in those subtrees are skipped).
+def pruning_false_negatives(tracker: AnytimeTracker, orig_board: Board, agent_options: dict, num_nodes=0):
+    allowable_false_negatives = agent_options["allowable_false_negatives"]
+    if tracker.solved or not tracker.expired(num_nodes):
+        return allowable_false_negatives
+    best_errors = count_false_negatives(orig_board) if tracker.best_errors is None else tracker.best_errors
+    return max(allowable_false_negatives, best_errors - 1)
+
+# Returns should_stop wrapped to give the best board reached by the engine to the tracker, to send the approximations once the budget runs out,
+#   and to keep the engine's agent pruning with pruning_false_negatives (starting right away, so that it also applies to the root).
+# The engine keeps searching once the budget runs out, so nothing that the exact search has found (or ruled out) so far is lost.
+def anytime_stop(engine: SearchEngine, tracker: AnytimeTracker, orig_board: Board, agent_options: dict, should_stop: Callable[[], bool] = None):
+    def update():
+        if engine.best is not None:
+            tracker.offer(*engine.best)
+        tracker.check(engine.nodes_expanded)
+        engine.agent.allowable_false_negatives = pruning_false_negatives(tracker, orig_board, agent_options, engine.nodes_expanded)
+    update()
+
+    def search_stop():
+        update()
+        return should_stop is not None and should_stop()
+    return search_stop
+
+# Searches the whole tree with num_workers processes (see run_parallel, which is given stats_interval, on_stats and profile) in anytime mode:
+#   the workers' best boards are given to the tracker, the approximations are sent once the budget runs out, and the workers prune with
+#   pruning_false_negatives (which they keep reading, so they carry on past the budget instead of being stopped).
+def run_anytime_parallel(orig_board: Board, agent_options: dict, tracker: AnytimeTracker, on_success: Callable[[list], None], num_workers, should_stop: Callable[[], bool] = None,
+                         stats_interval: float = None, on_stats: Callable[[dict], None] = None, profile: str = None):
+    def search_stop():
+        tracker.check()
+        return should_stop is not None and should_stop()
+    return run_parallel(orig_board, agent_options, on_success, num_workers, search_stop, stats_interval, on_stats, profile, tracker.offer,
+                        lambda: pruning_false_negatives(tracker, orig_board, agent_options))
+
+# Searches for approximations from the root once the exact search is over before the budget ran out (so that it has no frontier left to continue),
+#   giving each board reached to the tracker, and exact solutions to on_success, until the search is over or should_stop() returns True.
+# The budget is ended, so the whole search prunes with the relaxed allowance. The search starts with a new agent, since the exact search's
+#   transposition table would skip every subtree of the root. Returns the result of the search.
+# With more than one worker, the search is split across num_workers processes (see run_anytime_parallel), and stats is not used.
+def search_approximations(orig_board: Board, agent_options: dict, tracker: AnytimeTracker, on_success: Callable[[list], None], should_stop: Callable[[], bool] = None, stats=None,
+                          num_workers=1, stats_interval: float = None, on_stats: Callable[[dict], None] = None, profile: str = None):
+    tracker.end()
+    tracker.finish()
+    if num_workers > 1:
+        return run_anytime_parallel(orig_board, agent_options, tracker, on_success, num_workers, should_stop, stats_interval, on_stats, profile)
+
+    agent = TetrisAgent(orig_board.shape, **agent_options)
+    if stats is not None:
+        agent.instrument(stats)
+    engine = SearchEngine(agent, orig_board, on_success)
+    search_stop = anytime_stop(engine, tracker, orig_board, agent_options, should_stop)
+    result = engine.run(search_stop)
+    search_stop()
+    if agent.transposition_table is not None:
+        agent.transposition_table.log_stats()
+    return result
@@ -0,0 +1,112 @@
+import random
+from collections.abc import Callable
+from tetris_env import Board, SimulationResult, piece_ids
+from tetris_features import SearchState
+from transposition import TranspositionTable
+
+# Beam width used when a job does not give one
+DEFAULT_BEAM_WIDTH = 32
+
+# Beam search over placement sequences, as an alternative to the depth-first search of SearchEngine.
+# Instead of backtracking through every placement, each step expands every board in the beam by one piece, and keeps only the beam_width best
+#   of the resulting boards (by the agent's score, the same one SearchEngine orders placements by, with ties in random order) for the next step.
+# Placements are generated, scored and checked for failure the same way as in SearchEngine, and each solution is given to on_success
+#   as its list of placements, (shape, anchor), so its animation is built the same way too.
+# A drawing that needs n pieces takes at most n steps, but solutions that are only reachable through boards that fall out of the beam are never found.
+class BeamSearch:
+    def __init__(self, agent, orig_board: Board, on_success: Callable[[list], None], beam_width=DEFAULT_BEAM_WIDTH):
+        if beam_width < 1:
+            raise ValueError(f"Beam width must be at least 1: {beam_width}")
+        self.agent = agent
+        self.orig_board = orig_board
+        self.on_success = on_success
+        self.beam_width = beam_width
+        self.nodes_expanded = 0
+
+        # (errors, placements) of the board reached with the fewest errors so far, if any (as for SearchEngine)
+        self.best = None
+
+        # Each board in the beam is kept as its own SearchState, along with the placements that reach it.
+        # Their boards are hashed (by a table that only hashes, and never records anything) to skip boards already in the next beam.
+        self.hasher = TranspositionTable(orig_board.shape, 0)
+        root = SearchState(orig_board.copy(), agent.features, self.hasher)
+        self.beam = []
+        self.result = self._evaluate(root)
+        if self.result == SimulationResult.NOT_DONE:
+            self.beam.append((root, []))
+
+    @property
+    def finished(self):
+        return self.result != SimulationResult.NOT_DONE
+
+    # Returns whether a board is a solution (SUCCESS), can no longer lead to one (FAILURE), or still needs placements (NOT_DONE)
+    def _evaluate(self, state: SearchState):
+        agent, stats = self.agent, self.agent.stats
+        if state.num_false_positives > agent.allowable_false_positives or agent.would_fail(state.num_false_positives, state.islands.num_stragglers, state.islands.num_islands):
+            if stats is not None:
+                stats.prune("would_fail")
+            return SimulationResult.FAILURE
+        if state.num_false_negatives <= agent.allowable_false_negatives:
+            return SimulationResult.SUCCESS
+        if agent.prune_bounds and agent.cannot_succeed(state.board, state.num_false_positives, state.islands):
+            if stats is not None:
+                stats.prune("lower_bound")
+            return SimulationResult.FAILURE
+        return SimulationResult.NOT_DONE
+
+    # Runs the search until the beam is empty or should_stop() returns True (checked between steps).
+    # Returns the result of the search, which is NOT_DONE if it was suspended (and FAILURE once the beam is empty, as for SearchEngine).
+    def run(self, should_stop: Callable[[], bool] = None):
+        while self.beam:
+            if should_stop is not None and should_stop():
+                return SimulationResult.NOT_DONE
+            self._step()
+
+        if not self.finished:
+            self.result = SimulationResult.FAILURE
+        return self.result
+
+    # Expands every board in the beam by one piece, and keeps the best of the resulting boards as the next beam
+    def _step(self):
+        agent, stats = self.agent, self.agent.stats
+        candidates = []
+        for index, (state, _) in enumerate(self.beam):
+            self.nodes_expanded += 1
+            if stats is not None:
+                stats.nodes += 1
+            piece_order = random.sample(piece_ids, len(piece_ids))
+            placements = agent.get_all_scored_placements(state.board, piece_order, state.evaluator, state.islands)
+            if len(placements) == 0 and stats is not None:
+                stats.prune("no_placements")
+            candidates.extend((score, shape, anchor, index) for score, shape, anchor in placements)
+
+        # Take the best placements in order until the next beam is full, skipping any that reach a board already in it.
+        # Each placement is applied to its parent's state to be hashed and evaluated, then undone, so only the boards kept in the next beam get their own state.
+        next_beam = []
+        seen = set()
+        for _, shape, anchor, index in (agent.order_placements(candidates) if candidates else []):
+            if len(next_beam) >= self.beam_width:
+                break
+            state, sequence = self.beam[index]
+            change = state.apply(shape, anchor, not agent.enforce_gravity)
+            key = state.hash
+            if key in seen:
+                state.undo(change)
+                continue
+            seen.add(key)
+
+            child_sequence = [*sequence, (shape, anchor)]
+            errors = state.num_false_positives + state.num_false_negatives
+            if self.best is None or errors < self.best[0]:
+                self.best = (errors, child_sequence)
+            if stats is not None:
+                stats.reached(len(child_sequence), errors)
+
+            result = self._evaluate(state)
+            if result == SimulationResult.NOT_DONE:
+                next_beam.append((SearchState(state.board.copy(), agent.features, self.hasher), child_sequence))
+            state.undo(change)
+            if result == SimulationResult.SUCCESS:
+                agent.num_solutions += 1
+                self.on_success(child_sequence)
+        self.beam = next_beam
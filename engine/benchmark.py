@@ -0,0 +1,433 @@
+import sys, json, time, random, argparse, platform, statistics, subprocess, os
+import multiprocessing as mp
+import numpy as np
+
+# Benchmarks the search on a fixed set of target grids and options, with seeded runs.
+# Each run happens in a fresh process (so that its peak memory is its own), and measures:
+#   the time to the first solution, solutions per minute, nodes expanded per second, and peak RSS.
+#
+#   python benchmark.py run [--output results.json] [--targets ...] [--seeds N] [--time-limit S] [--max-solutions N]
+#   python benchmark.py compare base.json new.json [--threshold 0.1]
+#   python benchmark.py check-pruning [--targets ...] [--random N] [--time-limit S]
+#   python benchmark.py check-features [--boards N] [--width W] [--height H]
+
+# Rows added above every target, to allow for block spawning (the same as tetrifyEngine)
+NUM_ADDED_ROWS = 6
+
+# Targets, drawn with '#' for selected cells and '.' for the rest
+TARGETS = {
+    # Small glyphs
+    "glyph_T": [
+        "########",
+        "########",
+        "...##...",
+        "...##...",
+        "...##...",
+        "...##...",
+    ],
+    "glyph_A": [
+        "...##...",
+        ".##..##.",
+        ".##..##.",
+        ".######.",
+        ".##..##.",
+        ".##..##.",
+    ],
+    # A wide logo, with gaps between its letters
+    "logo_wide": [
+        "####.####.####.####",
+        ".##..##....##...##.",
+        ".##..###...##...##.",
+        ".##..##....##...##.",
+        ".##..####..##..###.",
+    ],
+    # A large filled region
+    "filled_block": [
+        "..............",
+        "..##########..",
+        "..##########..",
+        "..##########..",
+        "..##########..",
+        "##############",
+        "##############",
+        "##############",
+        "##############",
+    ],
+    # Sparse line art
+    "line_art": [
+        "###...........",
+        ".###..........",
+        "..##......####",
+        "...##.........",
+        "....##........",
+        "..........####",
+    ],
+}
+
+# Option combinations: (allowable false positives, allowable false negatives, enforce gravity, reduce_Is)
+OPTIONS = [
+    (0, 0, True, False),
+    (0, 0, True, True),
+    (2, 2, True, True),
+    (0, 0, False, False),
+    (2, 2, False, True),
+]
+
+# Metrics compared between results, and whether a higher value is better for each
+METRICS = {
+    "time_to_first_solution": False,
+    "solutions_per_minute": True,
+    "nodes_per_second": True,
+    "peak_rss_kb": False,
+}
+
+def target_grid(name):
+    rows = TARGETS[name]
+    grid = np.array([[cell == "#" for cell in row] for row in rows], dtype=bool)
+    return np.vstack((np.zeros((NUM_ADDED_ROWS, grid.shape[1]), dtype=bool), grid))
+
+def options_dict(options):
+    false_positives, false_negatives, enforce_gravity, reduce_Is = options
+    return {"false_positives": false_positives, "false_negatives": false_negatives, "enforce_gravity": enforce_gravity, "reduce_Is": reduce_Is}
+
+def case_key(run):
+    options = run["options"]
+    return f'{run["target"]} fp={options["false_positives"]} fn={options["false_negatives"]} gravity={int(options["enforce_gravity"])} reduce_Is={int(options["reduce_Is"])}'
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+# Runs one seeded search until it is finished, has run for time_limit seconds, or has found max_solutions solutions
+def _run_case(target, options, seed, time_limit, max_solutions, build_animations):
+    from tetris_env import board_from_grid
+    from tetris_agent import TetrisAgent
+    from tetris_search import SearchEngine
+
+    board = board_from_grid(target_grid(target))
+    agent = TetrisAgent(board.shape, *options)
+    solution_times = []
+
+    def on_success(placements):
+        if build_animations:
+            agent.build_animation_from_placements(board.copy(), placements)
+        solution_times.append(time.perf_counter() - start)
+
+    random.seed(seed)
+    start = time.perf_counter()
+    engine = SearchEngine(agent, board, on_success)
+    engine.run(should_stop=lambda: len(solution_times) >= max_solutions or time.perf_counter() - start >= time_limit)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "target": target,
+        "options": options_dict(options),
+        "seed": seed,
+        "finished": engine.finished,
+        "elapsed": elapsed,
+        "solutions": len(solution_times),
+        "time_to_first_solution": solution_times[0] if solution_times else None,
+        "solutions_per_minute": len(solution_times) / elapsed * 60 if elapsed > 0 else None,
+        "nodes": engine.nodes_expanded,
+        "nodes_per_second": engine.nodes_expanded / elapsed if elapsed > 0 else None,
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+
+# Returns a random target that is known to be reachable: the cells filled by dropping num_pieces random pieces onto an empty board
+def random_target_grid(rng: random.Random, width, height, num_pieces):
+    from tetris_env import Board, CellValue, apply_shape, piece_ids
+    from tetris_features import enumerate_placements
+
+    board = Board(np.full((width, NUM_ADDED_ROWS + height), CellValue.EMPTY.value, dtype=np.uint8))
+    for _ in range(num_pieces):
+        batch = enumerate_placements(board, piece_ids)
+        inside = np.flatnonzero(np.all(batch.cell_ys >= NUM_ADDED_ROWS, axis=1))
+        if len(inside) == 0:
+            break
+        i = rng.choice(inside.tolist())
+        apply_shape((int(batch.piece_ids[i]), int(batch.rotation_ids[i])), tuple(batch.anchors[i].tolist()), board, True)
+    return (board.values != CellValue.EMPTY.value).T
+
+# Runs one seeded search until it is finished or has run for time_limit seconds, and returns every solution found (as a set of placement sequences)
+def _solution_set(grid, options, seed, time_limit, prune_bounds):
+    from tetris_env import board_from_grid
+    from tetris_agent import TetrisAgent
+    from tetris_search import SearchEngine
+
+    board = board_from_grid(grid)
+    agent = TetrisAgent(board.shape, *options, prune_bounds=prune_bounds)
+    solutions = set()
+    random.seed(seed)
+    start = time.perf_counter()
+    engine = SearchEngine(agent, board, lambda placements: solutions.add(tuple(placements)))
+    engine.run(should_stop=lambda: time.perf_counter() - start >= time_limit)
+    return engine.finished, solutions, engine.nodes_expanded
+
+# Checks that pruning by lower bounds (TetrisAgent.cannot_succeed) never loses a solution, by comparing the solutions of searches with and without it.
+# Only cases where both searches finish can show that the solutions are the same, but a solution missing from a finished pruned search always counts as an error.
+# Returns the number of errors.
+def check_pruning(args):
+    grids = {name: target_grid(name) for name in args.targets or []}
+    rng = random.Random(args.random_seed)
+    for i in range(args.random):
+        grids[f"random_{i}"] = random_target_grid(rng, args.width, args.height, args.pieces)
+
+    errors = unfinished = 0
+    for name, grid in grids.items():
+        for options in OPTIONS:
+            key = case_key({"target": name, "options": options_dict(options)})
+            finished, solutions, nodes = _solution_set(grid, options, 0, args.time_limit, False)
+            pruned_finished, pruned_solutions, pruned_nodes = _solution_set(grid, options, 0, args.time_limit, True)
+            missing = solutions - pruned_solutions if pruned_finished else set()
+            if missing or (finished and pruned_finished and solutions != pruned_solutions):
+                errors += 1
+                status = f"ERROR: {len(missing)} solutions lost, {len(pruned_solutions - solutions)} gained"
+            elif finished and pruned_finished:
+                status = "same"
+            else:
+                unfinished += 1
+                status = "unfinished"
+            print(f"{key:<55} {len(solutions):>6} / {len(pruned_solutions):>6} solutions {nodes:>8} / {pruned_nodes:>8} nodes  {status}")
+    print(f"{errors} errors, {unfinished} unfinished cases")
+    return errors
+
+# Returns the per-column form of each feature computed one cell at a time (as the features were before they were vectorized),
+#   as functions from a values array shaped (width, height) to a list with each column's value
+def _reference_column_features():
+    from tetris_env import CellValue, count_false_negatives, count_false_positives, count_buried_false_negatives, count_wells, count_towers
+
+    def is_false_negative(value):
+        return value == CellValue.FALSE_NEGATIVE.value
+    def is_filled(value):
+        return value == CellValue.FILLED.value or value == CellValue.FALSE_POSITIVE.value
+
+    def false_negatives(values):
+        return [sum(1 for value in column if is_false_negative(value)) for column in values]
+
+    def false_positives(values):
+        return [sum(1 for value in column if value == CellValue.FALSE_POSITIVE.value) for column in values]
+
+    # Works up each column from the bottom, burying the false negatives counted so far under every filled cell
+    def buried_false_negatives(values):
+        output = []
+        for column in values:
+            buried = count = 0
+            for value in reversed(column):
+                if is_false_negative(value):
+                    count += 1
+                if is_filled(value):
+                    buried += count
+                    count = 0
+            output.append(buried)
+        return output
+
+    # Counts the 3-high runs of cells of each column that neither horizontal neighbor shares
+    def isolated_runs(values, in_run):
+        width, height = values.shape
+        output = []
+        for x in range(width):
+            runs = run_height = 0
+            for y in reversed(range(height)):
+                if in_run(values[x, y]):
+                    if (x - 1 < 0 or not in_run(values[x - 1, y])) and (x + 1 >= width or not in_run(values[x + 1, y])):
+                        run_height += 1
+                else:
+                    runs += run_height // 3
+                    run_height = 0
+            output.append(runs + run_height // 3)
+        return output
+
+    return {
+        count_false_negatives: false_negatives,
+        count_false_positives: false_positives,
+        count_buried_false_negatives: buried_false_negatives,
+        count_wells: lambda values: isolated_runs(values, is_false_negative),
+        count_towers: lambda values: isolated_runs(values, is_filled),
+    }
+
+# Returns a random board: target cells and filled cells are each scattered with a random density (with no filled cells in the added rows,
+#   so that pieces have room to spawn), and a cell is a false negative, a false positive or filled according to which of them it is
+def random_board(rng: np.random.Generator, width, height):
+    from tetris_env import Board, CellValue
+
+    shape = (width, NUM_ADDED_ROWS + height)
+    target = rng.random(shape) < rng.uniform(0.2, 0.8)
+    filled = rng.random(shape) < rng.uniform(0, 0.6)
+    filled[:, :NUM_ADDED_ROWS] = False
+    values = np.where(target, np.where(filled, CellValue.FILLED.value, CellValue.FALSE_NEGATIVE.value),
+                      np.where(filled, CellValue.FALSE_POSITIVE.value, CellValue.EMPTY.value))
+    return Board(values.astype(np.uint8))
+
+# Checks the incremental feature evaluation against slower ways of computing the same features, on random boards:
+#   each column_* function against its per-cell reference, and, for every placement of every piece (with and without gravity),
+#   FeatureEvaluator.features_after and FeatureEvaluator.update against a fresh FeatureEvaluator of the board with the placement applied.
+# Returns the number of errors.
+def check_features(args):
+    from tetris_env import apply_shape, column_features, piece_ids
+    from tetris_features import FeatureEvaluator, enumerate_placements
+
+    references = _reference_column_features()
+    features = list(column_features)
+    rng = np.random.default_rng(args.random_seed)
+    errors = num_placements = 0
+    for board_index in range(args.boards):
+        board = random_board(rng, args.width, args.height)
+        for feature in features:
+            columns, expected = column_features[feature](board.values).tolist(), references[feature](board.values)
+            if columns != expected:
+                errors += 1
+                print(f"Board {board_index}: {feature.__name__} columns are {columns}, not {expected}")
+
+        evaluator = FeatureEvaluator(features, board)
+        for enforce_gravity in (True, False):
+            batch = enumerate_placements(board, piece_ids, enforce_gravity)
+            after = evaluator.features_after(board, batch.cell_xs, batch.cell_ys)
+            for index in range(len(batch.anchors)):
+                shape, anchor = (int(batch.piece_ids[index]), int(batch.rotation_ids[index])), tuple(batch.anchors[index].tolist())
+                placed = board.copy()
+                apply_shape(shape, anchor, placed, True)
+                fresh = FeatureEvaluator(features, placed)
+                updated = FeatureEvaluator(features, board)
+                updated.update(placed, shape, anchor)
+                num_placements += 1
+                if not np.array_equal(after[:, index], fresh.totals):
+                    errors += 1
+                    print(f"Board {board_index}: features_after gives {after[:, index].tolist()} for {shape} at {anchor}, not {fresh.totals.tolist()}")
+                if not np.array_equal(updated.columns, fresh.columns) or not np.array_equal(updated.totals, fresh.totals):
+                    errors += 1
+                    print(f"Board {board_index}: update leaves different columns than a fresh evaluation for {shape} at {anchor}")
+    print(f"{args.boards} boards, {num_placements} placements, {errors} errors")
+    return errors
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Returns the median of each metric over the runs of each case (a target with a combination of options)
+def summarize(runs):
+    cases = {}
+    for run in runs:
+        cases.setdefault(case_key(run), []).append(run)
+    summary = {}
+    for key, case_runs in cases.items():
+        summary[key] = {"runs": len(case_runs), "solutions": sum(run["solutions"] for run in case_runs)}
+        for metric in METRICS:
+            values = [run[metric] for run in case_runs if run[metric] is not None]
+            summary[key][metric] = statistics.median(values) if values else None
+    return summary
+
+def run_benchmark(args):
+    targets = args.targets or list(TARGETS)
+    # Every run gets a fresh interpreter
+    context = mp.get_context("spawn")
+    runs = []
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for target in targets:
+            for options in OPTIONS:
+                for seed in range(args.seeds):
+                    run = pool.apply(_run_case, (target, options, seed, args.time_limit, args.max_solutions, args.animations))
+                    runs.append(run)
+                    first = "-" if run["time_to_first_solution"] is None else f'{run["time_to_first_solution"]:.3f}s'
+                    print(f'{case_key(run)} seed={seed}: {run["solutions"]} solutions, first {first}, {run["nodes_per_second"]:.0f} nodes/s, {run["peak_rss_kb"]} KB', file=sys.stderr)
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "seeds": args.seeds,
+            "time_limit": args.time_limit,
+            "max_solutions": args.max_solutions,
+            "animations": args.animations,
+        },
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}", file=sys.stderr)
+
+# Prints the change in each metric for every case in both results, and returns the number of changes worse than the threshold
+def compare_results(args):
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    regressions = 0
+    print(f'{"case":<55} {"metric":<24} {"base":>12} {"new":>12} {"change":>8}')
+    for key in base["summary"]:
+        if key not in new["summary"]:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old_value, new_value = base["summary"][key][metric], new["summary"][key][metric]
+            if old_value is None or new_value is None or old_value == 0:
+                change_text = "n/a" if old_value != new_value else ""
+                flag = " !" if old_value is not None and new_value is None else ""
+                regressions += bool(flag)
+            else:
+                change = (new_value - old_value) / old_value
+                worse = -change if higher_is_better else change
+                change_text = f"{change:+.1%}"
+                flag = " !" if worse > args.threshold else ""
+                regressions += bool(flag)
+            print(f"{key:<55} {metric:<24} {_format(old_value):>12} {_format(new_value):>12} {change_text:>8}{flag}")
+    print(f"{regressions} regressions beyond {args.threshold:.0%}")
+    return regressions
+
+def _format(value):
+    return "-" if value is None else f"{value:.4g}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Tetrify search engine")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmark and save its results")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--targets", nargs="*", choices=list(TARGETS), help="Targets to run (all by default)")
+    run_parser.add_argument("--seeds", type=int, default=3, help="Number of seeded runs per case")
+    run_parser.add_argument("--time-limit", type=float, default=10, help="Seconds per run")
+    run_parser.add_argument("--max-solutions", type=int, default=100, help="Solutions after which a run stops")
+    run_parser.add_argument("--animations", action="store_true", help="Also build the animation of each solution (inline, as part of the search)")
+
+    compare_parser = commands.add_parser("compare", help="Compare two saved results")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+
+    pruning_parser = commands.add_parser("check-pruning", help="Check that pruning by lower bounds finds the same solutions as searching without it")
+    pruning_parser.add_argument("--targets", nargs="*", choices=list(TARGETS), help="Named targets to check (none by default, since they rarely finish)")
+    pruning_parser.add_argument("--random", type=int, default=20, help="Number of random (small and reachable) targets to check")
+    pruning_parser.add_argument("--random-seed", type=int, default=0)
+    pruning_parser.add_argument("--width", type=int, default=6, help="Width of the random targets")
+    pruning_parser.add_argument("--height", type=int, default=4, help="Height of the random targets")
+    pruning_parser.add_argument("--pieces", type=int, default=4, help="Pieces dropped to make each random target")
+    pruning_parser.add_argument("--time-limit", type=float, default=30, help="Seconds per search")
+
+    features_parser = commands.add_parser("check-features", help="Check the incremental feature evaluation against per-cell and full evaluations on random boards")
+    features_parser.add_argument("--boards", type=int, default=20, help="Number of random boards to check")
+    features_parser.add_argument("--random-seed", type=int, default=0)
+    features_parser.add_argument("--width", type=int, default=10, help="Width of the random boards")
+    features_parser.add_argument("--height", type=int, default=10, help="Height of the random boards (below the added rows)")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run_benchmark(args)
+    elif args.command == "compare":
+        sys.exit(1 if compare_results(args) else 0)
+    elif args.command == "check-pruning":
+        sys.exit(1 if check_pruning(args) else 0)
+    else:
+        sys.exit(1 if check_features(args) else 0)
+
+if __name__ == "__main__":
+    main()
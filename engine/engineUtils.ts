@@ -1,3 +1,5 @@
+import { AnimationDecoder } from "./animationDecoder.cjs";
+
 //True iff the app is running in electron window
 export const IS_ELECTRON = navigator.userAgent.toLowerCase().indexOf(" electron/") > -1;
 
@@ -16,10 +18,25 @@ function runEngineRemote(
     reduceWellsAndTowers,
     onSuccess,
     onEnd,
-    numThreads
+    numThreads,
+    timeoutSeconds,
+    onAnimationMessage,
+    onStats,
+    anytimeSeconds,
+    onApproximation
 ) {
     //Use websocket to start engine
     webSocket = new WebSocket("wss://tetrify.taylorgiles.me/wss");
+    const decoder = new AnimationDecoder();
+
+    //Approximations are never given to onSuccess, since they are not solutions
+    function deliverFrames(frames, approximate) {
+        if (!approximate) {
+            onSuccess(frames)
+        } else if (onApproximation) {
+            onApproximation(frames)
+        }
+    }
 
     webSocket.addEventListener("open", (event) => {
         //Build config object
@@ -29,6 +46,7 @@ function runEngineRemote(
             false_negatives: falseNegatives,
             enforce_gravity: enforceGravity,
             reduce_Is: reduceWellsAndTowers,
+            anytime_seconds: anytimeSeconds,
         };
 
         //Send data to server
@@ -37,7 +55,7 @@ function runEngineRemote(
 
 
     /**
-     * React to messages from server (log and frames)
+     * React to messages from server (log, frames, chunks of compact animations, and search statistics)
      */
     webSocket.addEventListener('message', (event) => {
         try {
@@ -47,9 +65,22 @@ function runEngineRemote(
                 console.log(`[LOG] ${data.log}`)
             }
 
-            //Frames (animation finding was successful)
+            //Frames (animation finding was successful, or found a better approximation)
             if ("frames" in data) {
-                onSuccess(data.frames)
+                deliverFrames(data.frames, data.approximate)
+            }
+
+            //Chunk of a compact animation (the frames are complete after its last chunk)
+            if ("animation" in data) {
+                let frames = decoder.add(data.animation);
+                if (frames) {
+                    deliverFrames(frames, data.approximate)
+                }
+            }
+
+            //Search statistics
+            if ("stats" in data) {
+                console.debug("[STATS]", data.stats)
             }
         } catch (e) {
             console.error(`Error parsing message from server: ${event.data}`, e)
@@ -84,7 +115,9 @@ export function runEngine(grid,
     reduceWellsAndTowers: boolean,
     onSuccess: (frames: string[][]) => any,
     onEnd: () => any,
-    numThreads: number) {
+    numThreads: number,
+    anytimeSeconds?: number,
+    onApproximation?: (frames: string[][]) => any) {
     return CHOSEN_FUNCTIONS._runEngine(grid,
         falsePositives,
         falseNegatives,
@@ -92,7 +125,12 @@ export function runEngine(grid,
         reduceWellsAndTowers,
         onSuccess,
         onEnd,
-        numThreads)
+        numThreads,
+        undefined,
+        undefined,
+        undefined,
+        anytimeSeconds,
+        onApproximation)
 
 }
 
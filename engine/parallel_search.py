@@ -0,0 +1,219 @@
+import os
+import queue
+import random
+import signal
+import multiprocessing as mp
+from collections.abc import Callable
+from tetris_env import Board, SimulationResult
+from tetris_agent import TetrisAgent
+from tetris_search import SearchEngine
+from search_stats import SearchStats, merge_stats, reporting, profiled
+from utils import log
+
+# Steps between each check of whether the coordinating process is still alive
+PARENT_CHECK_INTERVAL = 1000
+
+# Steps to wait before trying to donate work again, after having none to donate
+DONATE_RETRY_INTERVAL = 1000
+
+# Seconds to wait for a message from the workers before checking that they are all still running
+POLL_SECONDS = 1
+
+
+# Searches one part of the tree at a time, as given by the tasks queue, until it receives None.
+# While other workers are waiting for work (hungry > 0), the untried placements nearest the root of the current part are donated back as a new task.
+# If stats_interval is given, the worker's stats are sent every stats_interval seconds and after each task. If profile is given, the worker profiles itself to that path.
+# If track_best is True, the placements of each board with fewer errors than any the worker has reached before are sent too.
+# If pruning is given, the agent prunes with the allowance of false negatives in it (read at the start of each task and every PARENT_CHECK_INTERVAL steps),
+#   while solutions still need the job's own allowance.
+def _worker(orig_board: Board, agent_options: dict, tasks, results, hungry, parent_pid, index, stats_interval=None, profile=None, track_best=False, pruning=None):
+    # Forked workers start with the same random state (and signal handlers) as the coordinator, so each one needs its own
+    random.seed()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    with profiled(profile):
+        _search_tasks(orig_board, agent_options, tasks, results, hungry, parent_pid, index, stats_interval, track_best, pruning)
+
+def _search_tasks(orig_board: Board, agent_options: dict, tasks, results, hungry, parent_pid, index, stats_interval, track_best, pruning):
+    agent = TetrisAgent(orig_board.shape, **agent_options)
+    if stats_interval is not None:
+        agent.instrument(SearchStats())
+    steps = 0
+    next_donation = 0
+    nodes_expanded = 0
+    engine = None
+    best_errors = None
+
+    def on_success(placements):
+        results.put(("solution", placements))
+
+    def check_parent():
+        if os.getppid() != parent_pid:
+            # The coordinator was killed, so nobody is listening anymore
+            os._exit(1)
+
+    def should_stop():
+        nonlocal steps, best_errors
+        steps += 1
+        if steps % PARENT_CHECK_INTERVAL == 0:
+            check_parent()
+            if pruning is not None:
+                agent.allowable_false_negatives = pruning.value
+        if track_best and engine.best is not None and (best_errors is None or engine.best[0] < best_errors):
+            best_errors = engine.best[0]
+            results.put(("best", *engine.best))
+        return steps >= next_donation and hungry.value > 0
+
+    def send_stats(stats):
+        results.put(("stats", index, stats))
+    if agent.stats is not None:
+        should_stop = reporting(stats_interval, lambda: send_stats(agent.stats.to_dict()), should_stop)
+
+    while True:
+        try:
+            task = tasks.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            check_parent()
+            continue
+        if task is None:
+            break
+        results.put(("started",))
+
+        prefix, placements = task
+        engine = SearchEngine.from_task(agent, orig_board, on_success, prefix, placements)
+        if pruning is not None:
+            engine.allowable_false_negatives = agent_options["allowable_false_negatives"]
+            agent.allowable_false_negatives = pruning.value
+        while engine.run(should_stop) == SimulationResult.NOT_DONE:
+            with hungry.get_lock():
+                if hungry.value <= 0:
+                    continue
+                donation = engine.split()
+                if donation is None:
+                    next_donation = steps + DONATE_RETRY_INTERVAL
+                    continue
+                hungry.value -= 1
+            results.put(("task", donation))
+
+        nodes_expanded += engine.nodes_expanded
+        if agent.stats is not None:
+            send_stats(agent.stats.to_dict())
+        results.put(("done",))
+
+    summary = f"Worker {os.getpid()}: {nodes_expanded} nodes expanded"
+    if agent.transposition_table is not None:
+        summary += f", {agent.transposition_table.stats()['hit_rate']:.1%} transposition table hit rate"
+    results.put(("finished", summary))
+
+
+# Searches the whole tree with num_workers processes, calling on_success with the placements of each distinct solution found.
+# The tree is split into tasks, each being some of the placements of a node (given by the sequence of placements that reaches it).
+# It starts with one task per placement of the root. Whenever a worker runs out of tasks, a busy worker donates the untried placements nearest to the root of its own task.
+# Every solution passes through this process, which drops any placement sequence that has already been sent.
+# If should_stop() returns True (checked at least every POLL_SECONDS), the workers are stopped and NOT_DONE is returned.
+# If stats_interval is given, the workers are instrumented, and on_stats is called with their combined stats about every stats_interval seconds (and once at the end).
+# If profile is given, each worker writes its profile to that path, followed by its index (e.g. search.prof.0).
+# If on_best is given, it is called with (errors, placements) whenever a worker reaches a board with fewer errors than it had reached before (see SearchEngine.best).
+# If pruning_false_negatives is given, the agents prune with the allowance of false negatives it returns instead of the job's own, which only
+#   solutions still need (see pruning_false_negatives in anytime). It is called after each message from the workers.
+def run_parallel(orig_board: Board, agent_options: dict, on_success: Callable[[list], None], num_workers: int, should_stop: Callable[[], bool] = None,
+                 stats_interval: float = None, on_stats: Callable[[dict], None] = None, profile: str = None, on_best: Callable[[int, list], None] = None,
+                 pruning_false_negatives: Callable[[], int] = None):
+    # Expand the root here, to get the initial tasks
+    agent = TetrisAgent(orig_board.shape, **agent_options)
+    root = SearchEngine(agent, orig_board, on_success)
+    if pruning_false_negatives is not None:
+        agent.allowable_false_negatives = pruning_false_negatives()
+    if root.run(should_stop=lambda: True) != SimulationResult.NOT_DONE:
+        return root.result
+
+    context = mp.get_context()
+    tasks = context.Queue()
+    results = context.Queue()
+    hungry = context.Value("i", 0)
+    pruning = None if pruning_false_negatives is None else context.Value("i", agent.allowable_false_negatives)
+    workers = [context.Process(target=_worker, args=(orig_board, agent_options, tasks, results, hungry, os.getpid(), index, stats_interval, profile and f"{profile}.{index}",
+                                                      on_best is not None, pruning), daemon=True) for index in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    num_issued = num_started = num_done = 0
+    def issue(task):
+        nonlocal num_issued
+        tasks.put(task)
+        num_issued += 1
+
+    for placement in root.stack[0].placements:
+        issue(([], [placement]))
+
+    # The latest stats of each worker
+    worker_stats = {}
+    def send_stats():
+        if on_stats is not None and worker_stats:
+            on_stats(merge_stats(list(worker_stats.values())))
+    if stats_interval is not None:
+        stop_or_report = reporting(stats_interval, send_stats, should_stop)
+    else:
+        stop_or_report = should_stop
+
+    found = set()
+    try:
+        while num_done < num_issued:
+            if stop_or_report is not None and stop_or_report():
+                send_stats()
+                return SimulationResult.NOT_DONE
+            try:
+                message = results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("A search worker stopped unexpectedly")
+                continue
+
+            kind = message[0]
+            if kind == "started":
+                num_started += 1
+            elif kind == "done":
+                num_done += 1
+            elif kind == "task":
+                issue(message[1])
+            elif kind == "solution":
+                key = tuple(message[1])
+                if key not in found:
+                    found.add(key)
+                    agent.num_solutions += 1
+                    on_success(message[1])
+            elif kind == "stats":
+                worker_stats[message[1]] = message[2]
+            elif kind == "best":
+                on_best(message[1], message[2])
+            elif kind == "log":
+                log(message[1], **agent.log_fields)
+            if pruning is not None:
+                pruning.value = pruning_false_negatives()
+
+            # Ask for as many donations as there are idle workers without a queued task to take
+            num_idle = num_workers - (num_started - num_done)
+            with hungry.get_lock():
+                hungry.value = max(0, num_idle - (num_issued - num_started))
+
+        # Stop the workers, passing on their summaries
+        for _ in workers:
+            tasks.put(None)
+        num_finished = 0
+        while num_finished < num_workers:
+            message = results.get(timeout=POLL_SECONDS)
+            if message[0] == "finished":
+                num_finished += 1
+                log(message[1], **agent.log_fields)
+            elif message[0] == "stats":
+                worker_stats[message[1]] = message[2]
+        for worker in workers:
+            worker.join()
+        send_stats()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+        # Do not wait to send the tasks that are still queued (nothing will read them)
+        tasks.cancel_join_thread()
+    return SimulationResult.FAILURE
@@ -0,0 +1,199 @@
+import os
+import queue
+import random
+import signal
+import multiprocessing as mp
+import numpy as np
+from collections.abc import Callable
+from tetris_env import Board, CellValue, SimulationResult, MAX_START_ROW, apply_shape, count_false_positives, count_false_negatives
+from tetris_agent import TetrisAgent
+from tetris_search import SearchEngine
+from parallel_search import PARENT_CHECK_INTERVAL, POLL_SECONDS
+from utils import log
+
+# Nodes a strip is searched for at a time (unless it finds a solution first), before the strips are compared again to pick the next one
+STRIP_QUANTUM = 200
+
+# Returns the (start, end) column ranges of the independent strips of a board, which are separated by columns without any target cells.
+# Each run of such columns is split between the strips on either side of it (with its middle column going to the left one), so that
+#   every column belongs to exactly one strip. A board whose target cells are all in adjacent columns has a single strip.
+def split_regions(board: Board):
+    width = board.shape[0]
+    columns = np.flatnonzero(np.any(board.values == CellValue.FALSE_NEGATIVE.value, axis=1))
+    if len(columns) == 0:
+        return [(0, width)]
+    gaps = np.flatnonzero(np.diff(columns) > 1)
+    cuts = [int(end + 1 + (start - end) // 2) for end, start in zip(columns[gaps], columns[gaps + 1])]
+    return list(zip([0, *cuts], [*cuts, width]))
+
+# Returns the strips of a job's board (see split_regions) if they can be searched on their own (see run_regions), or None if they cannot.
+# Without any false positives, pieces only ever cover target cells, so every other cell stays empty, and no piece can cross the empty columns
+#   between strips. With gravity, a piece drops straight down its own columns, whose cells are the same on the strip as on the whole board.
+#   Without it, the piece spawns at the center of the strip rather than of the board, so the rows a piece can start in (and the row below them,
+#   which keeps it from locking) must have no target cells: the piece can then be moved along them from the board's spawn state to the strip's,
+#   and make the same moves as on the strip from there, since they stay within the strip's columns. Either way, the solutions of the strips
+#   can be placed on the whole board in any interleaved order, whatever the other strips hold.
+# The strips are searched with the job's allowances, and their errors add up once they are merged, so only jobs that allow no errors are split.
+# A solution of the whole board may still need moves through the columns of other strips, so it is not always made of solutions of the strips.
+def independent_regions(board: Board, agent_options: dict):
+    if agent_options["allowable_false_positives"] != 0 or agent_options["allowable_false_negatives"] != 0:
+        return None
+    if not agent_options["enforce_gravity"] and np.any(board.values[:, :MAX_START_ROW + 2] == CellValue.FALSE_NEGATIVE.value):
+        return None
+    regions = split_regions(board)
+    return regions if len(regions) > 1 else None
+
+# The search of one strip of a board, which is a board of its own (sharing none of its columns with the other strips)
+class _Strip:
+    def __init__(self, board: Board, start, end, agent_options: dict, stats=None):
+        self.board = Board(board.values[start:end].copy(), board.ghosts[start:end].copy(), board.piece_ids[start:end].copy())
+        self.start = start
+        self.agent = TetrisAgent(self.board.shape, **agent_options)
+        if stats is not None:
+            self.agent.instrument(stats)
+        self.engine = SearchEngine(self.agent, self.board, self._on_success)
+        self.num_solutions = 0
+
+        # Solutions found since the last turn, as (false positives, false negatives, placements on the whole board)
+        self.found = []
+
+    def _on_success(self, placements):
+        board = self.board.copy()
+        for shape, anchor in placements:
+            apply_shape(shape, anchor, board, not self.agent.enforce_gravity)
+        self.num_solutions += 1
+        self.found.append((count_false_positives(board), count_false_negatives(board), [(shape, (anchor[0] + self.start, anchor[1])) for shape, anchor in placements]))
+
+# Searches the strips a turn at a time, always picking the strip with the fewest solutions (and then the fewest nodes expanded),
+#   and calls on_solution(index, false_positives, false_negatives, placements) with each solution found on the strip with that index.
+# Returns FAILURE once every strip is finished, or as soon as one is finished without any solutions (so no solution of the board can be made from the strips),
+#   or NOT_DONE if should_stop() returned True.
+def _search_strips(strips: dict, on_solution: Callable, should_stop: Callable[[], bool] = None):
+    active = dict(strips)
+    while active:
+        index, strip = min(active.items(), key=lambda item: (item[1].num_solutions, item[1].engine.nodes_expanded))
+        turn_end = strip.engine.nodes_expanded + STRIP_QUANTUM
+        stopped = False
+        def turn_over():
+            nonlocal stopped
+            stopped = should_stop is not None and should_stop()
+            return stopped or bool(strip.found) or strip.engine.nodes_expanded >= turn_end
+        strip.engine.run(turn_over)
+
+        for solution in strip.found:
+            on_solution(index, *solution)
+        strip.found.clear()
+        if strip.engine.finished:
+            del active[index]
+            if strip.num_solutions == 0:
+                return SimulationResult.FAILURE
+        if stopped:
+            return SimulationResult.NOT_DONE
+    return SimulationResult.FAILURE
+
+# Combines the solutions of the strips into solutions of the whole board, which are given to on_success.
+# Once every strip has a solution, the n-th solution of a strip is combined with a solution of each other strip, taking their solutions
+#   in turn (the (n mod k)-th of the k found so far), so that the merged solutions vary in every strip.
+# If that combination is not within the job's allowances, the solutions of the other strips with the fewest errors are used instead,
+#   and the new solution is dropped if even those are not. The placements of the strips are interleaved in a random order.
+class _Merger:
+    def __init__(self, num_strips, agent_options: dict, on_success: Callable[[list], None]):
+        self.solutions = [[] for _ in range(num_strips)]
+        self.allowable_false_positives = agent_options["allowable_false_positives"]
+        self.allowable_false_negatives = agent_options["allowable_false_negatives"]
+        self.on_success = on_success
+        self.num_solutions = 0
+
+    def add(self, index, num_false_positives, num_false_negatives, placements):
+        self.solutions[index].append((num_false_positives, num_false_negatives, placements))
+        if not all(self.solutions):
+            return
+        turn = len(self.solutions[index]) - 1
+        parts = [solutions[turn % len(solutions)] for solutions in self.solutions]
+        if not self.allowed(parts):
+            parts = [min(solutions, key=lambda solution: solution[0] + solution[1]) for solutions in self.solutions]
+            parts[index] = self.solutions[index][-1]
+            if not self.allowed(parts):
+                return
+
+        # Each strip's placements stay in their own order, but the strips take turns at random
+        turns = [part_index for part_index, part in enumerate(parts) for _ in part[2]]
+        random.shuffle(turns)
+        remaining = [iter(part[2]) for part in parts]
+        self.num_solutions += 1
+        self.on_success([next(remaining[part_index]) for part_index in turns])
+
+    # Returns True iff the parts together are within the job's allowances
+    def allowed(self, parts):
+        return sum(part[0] for part in parts) <= self.allowable_false_positives and sum(part[1] for part in parts) <= self.allowable_false_negatives
+
+# Searches the given strips, sending each solution, and then a "failed" or "finished" message, to the results queue
+def _worker(orig_board: Board, agent_options: dict, regions: dict, results, parent_pid):
+    random.seed()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    strips = {index: _Strip(orig_board, start, end, agent_options) for index, (start, end) in regions.items()}
+    steps = 0
+    def check_parent():
+        nonlocal steps
+        steps += 1
+        if steps % PARENT_CHECK_INTERVAL == 0 and os.getppid() != parent_pid:
+            # The coordinator was killed, so nobody is listening anymore
+            os._exit(1)
+        return False
+    result = _search_strips(strips, lambda *solution: results.put(("solution", *solution)), check_parent)
+    nodes_expanded = sum(strip.engine.nodes_expanded for strip in strips.values())
+    results.put(("failed" if any(strip.num_solutions == 0 for strip in strips.values()) else "finished", f"Worker {os.getpid()}: {nodes_expanded} nodes expanded in {len(strips)} strips"))
+
+# Searches a board whose target is split into independent strips (see independent_regions) one strip at a time, calling on_success with each
+#   solution of the whole board made from the solutions of the strips (see _Merger). Each strip is searched with the job's full allowances,
+#   so the strips should come from independent_regions, which only splits jobs that allow no errors.
+# With more than one worker, the strips are dealt out between up to num_workers processes, each searching its own strips in turns.
+# If stats is given, the agents of the strips are instrumented with it (which is only done when the strips are searched in this process).
+# Returns NOT_DONE if should_stop() returned True, and otherwise FAILURE once the search is over (as for SearchEngine).
+def run_regions(orig_board: Board, agent_options: dict, regions: list, on_success: Callable[[list], None], num_workers=1,
+                should_stop: Callable[[], bool] = None, stats=None):
+    merger = _Merger(len(regions), agent_options, on_success)
+    log_fields = agent_options.get("log_fields") or {}
+    num_workers = min(num_workers, len(regions))
+    if num_workers <= 1:
+        strips = {index: _Strip(orig_board, start, end, agent_options, stats) for index, (start, end) in enumerate(regions)}
+        result = _search_strips(strips, merger.add, should_stop)
+        log(f"Searched {len(regions)} strips: {sum(strip.engine.nodes_expanded for strip in strips.values())} nodes expanded, {merger.num_solutions} solutions", **log_fields)
+        return result
+
+    context = mp.get_context()
+    results = context.Queue()
+    workers = [context.Process(target=_worker, args=(orig_board, agent_options, {index: region for index, region in enumerate(regions) if index % num_workers == worker_index},
+                                                     results, os.getpid()), daemon=True) for worker_index in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        num_finished = 0
+        while num_finished < num_workers:
+            if should_stop is not None and should_stop():
+                return SimulationResult.NOT_DONE
+            try:
+                message = results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("A search worker stopped unexpectedly")
+                continue
+
+            kind = message[0]
+            if kind == "solution":
+                merger.add(*message[1:])
+            elif kind == "finished":
+                num_finished += 1
+                log(message[1], **log_fields)
+            elif kind == "failed":
+                # No solution of the whole board can be made from a strip without any solutions
+                log(message[1], **log_fields)
+                return SimulationResult.FAILURE
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    return SimulationResult.FAILURE
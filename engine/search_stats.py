@@ -0,0 +1,103 @@
+import time
+import cProfile
+import contextlib
+
+# Counters and timings of a search, collected while an agent is instrumented (see TetrisAgent.instrument).
+# Placements are counted when generated (each one is then scored) and when kept as branches of the search.
+# The best partial score is the fewest errors (false positives plus unfilled false negatives) of any board reached so far,
+#   which shows whether a search is still getting closer to a solution.
+class SearchStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.nodes = 0
+        self.placements_generated = 0
+        self.placements_kept = 0
+        self.pruned = {}
+        self.max_depth = 0
+        self.best_partial_score = None
+        self.timings = {}
+
+    # Records branches of the search that were cut off for the given reason
+    def prune(self, reason, count=1):
+        self.pruned[reason] = self.pruned.get(reason, 0) + count
+
+    # Records a board reached at the given depth (number of placements) with the given number of errors
+    def reached(self, depth, errors):
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.best_partial_score is None or errors < self.best_partial_score:
+            self.best_partial_score = errors
+
+    # Returns a version of the function that adds the duration of each call to the timing with the given name
+    def timed(self, name, function):
+        timing = self.timings.setdefault(name, [0, 0.0])
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing[0] += 1
+                timing[1] += time.perf_counter() - start
+        return timed_function
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            "elapsed": elapsed,
+            "nodes": self.nodes,
+            "nodes_per_second": self.nodes / elapsed if elapsed > 0 else 0,
+            "placements_generated": self.placements_generated,
+            "placements_kept": self.placements_kept,
+            "pruned": dict(self.pruned),
+            "max_depth": self.max_depth,
+            "best_partial_score": self.best_partial_score,
+            "timings": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.timings.items()},
+        }
+
+# Combines the stats (from to_dict) of searches that ran at the same time, such as those of parallel workers
+def merge_stats(stats_dicts: list):
+    merged = {
+        "elapsed": max((stats["elapsed"] for stats in stats_dicts), default=0),
+        "nodes": sum(stats["nodes"] for stats in stats_dicts),
+        "nodes_per_second": sum(stats["nodes_per_second"] for stats in stats_dicts),
+        "placements_generated": sum(stats["placements_generated"] for stats in stats_dicts),
+        "placements_kept": sum(stats["placements_kept"] for stats in stats_dicts),
+        "pruned": {},
+        "max_depth": max((stats["max_depth"] for stats in stats_dicts), default=0),
+        "best_partial_score": min((stats["best_partial_score"] for stats in stats_dicts if stats["best_partial_score"] is not None), default=None),
+        "timings": {},
+    }
+    for stats in stats_dicts:
+        for reason, count in stats["pruned"].items():
+            merged["pruned"][reason] = merged["pruned"].get(reason, 0) + count
+        for name, timing in stats["timings"].items():
+            total = merged["timings"].setdefault(name, {"calls": 0, "seconds": 0.0})
+            total["calls"] += timing["calls"]
+            total["seconds"] += timing["seconds"]
+    return merged
+
+# Returns a should_stop function for a search (checking the given one, if any) that also calls report every interval seconds
+def reporting(interval: float, report, should_stop=None):
+    next_report = time.monotonic() + interval
+    def should_stop_or_report():
+        nonlocal next_report
+        if time.monotonic() >= next_report:
+            report()
+            next_report = time.monotonic() + interval
+        return should_stop is not None and should_stop()
+    return should_stop_or_report
+
+# Profiles the code run in this context with cProfile, and writes the profile to the given path (if it is None, nothing is profiled).
+# The file can be read with pstats (e.g. python -m pstats <path>) or snakeviz.
+@contextlib.contextmanager
+def profiled(path):
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import numpy as np
+from tetris_env import Board, CellValue, orientation_table, piece_names, apply_shape, count_false_positives, count_false_negatives
+from tetris_features import enumerate_placements
+
+# Limits used when a cache is not given its own
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_SOLUTIONS = 50
+
+# The piece whose cells are the mirror image of each piece's cells (J and L swap, as do S and Z)
+_mirrored_names = {"J": "L", "L": "J", "S": "Z", "Z": "S"}
+MIRRORED_PIECES = [piece_names.index(_mirrored_names.get(name, name)) for name in piece_names]
+
+# _mirrored_shapes[piece_id][rotation_id] is the (piece_id, rotation_id, tx, ty) of the mirror image of that shape:
+#   a shape at anchor (x, y) on a board of width w has the same cells as its mirror image at anchor (w - 1 - x - tx, y - ty) on the mirrored board
+def _mirrored_shape(piece_id, rotation_id):
+    mirrored_cells = [(-i, j) for i, j in orientation_table[piece_id][rotation_id].cells]
+    mirrored_id = MIRRORED_PIECES[piece_id]
+    for mirrored_rotation_id, orientation in enumerate(orientation_table[mirrored_id]):
+        tx = min(i for i, _ in orientation.cells) - min(i for i, _ in mirrored_cells)
+        ty = min(j for _, j in orientation.cells) - min(j for _, j in mirrored_cells)
+        if sorted(orientation.cells) == sorted((i + tx, j + ty) for i, j in mirrored_cells):
+            return mirrored_id, mirrored_rotation_id, tx, ty
+    raise ValueError(f"No mirror image of {piece_names[piece_id]} rotation {rotation_id}")
+_mirrored_shapes = [[_mirrored_shape(piece_id, rotation_id) for rotation_id in range(len(orientations))] for piece_id, orientations in enumerate(orientation_table)]
+
+# Mirrors placements, given as [piece_id, rotation_id, x, y] lists, across a board (or part of a board) of the given width
+def mirror_placements(placements: list, width):
+    mirrored = []
+    for piece_id, rotation_id, x, y in placements:
+        mirrored_id, mirrored_rotation_id, tx, ty = _mirrored_shapes[piece_id][rotation_id]
+        mirrored.append([mirrored_id, mirrored_rotation_id, width - 1 - x - tx, y - ty])
+    return mirrored
+
+# Returns whether the placements, given as (shape, anchor) tuples, can be made in order on the board (each being one that the search
+#   could have made there) and leave it within the allowances of the agent options, i.e. whether they are a solution of the job
+def is_solution(board: Board, placements: list, agent_options: dict):
+    board = board.copy()
+    enforce_gravity = agent_options["enforce_gravity"]
+    for shape, anchor in placements:
+        batch = enumerate_placements(board, [shape[0]], enforce_gravity)
+        if not np.any((batch.rotation_ids == shape[1]) & np.all(batch.anchors == anchor, axis=1)):
+            return False
+        apply_shape(shape, anchor, board, not enforce_gravity)
+    return count_false_positives(board) <= agent_options["allowable_false_positives"] and count_false_negatives(board) <= agent_options["allowable_false_negatives"]
+
+# A cache on disk of the solutions found for each job, so that a job that was run before can send its solutions right away.
+# Jobs share an entry if their targets are the same once cropped to their bounding boxes (keeping the number of empty rows below,
+#   which matters with gravity), or are mirror images of each other, and they have the same allowances, gravity and reduce_Is.
+# Each entry is a JSON file in the directory, named by the hash of its key, holding up to max_solutions solutions
+#   (as placements relative to the bounding box of the key's target, which is whichever of the target and its mirror image comes first).
+# Entries are evicted least recently used first (by the modification time of their files, which is updated whenever they are read)
+#   once there are more than max_entries of them.
+# Jobs with the same key may still have boards of different sizes, so cached solutions are only returned once they are replayed
+#   on the job's board and found to be solutions there too (see is_solution).
+class SolutionCache:
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES, max_solutions=DEFAULT_MAX_SOLUTIONS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_solutions = max_solutions
+        os.makedirs(directory, exist_ok=True)
+
+    # Returns the key of a job (or None if its target is empty), the corner of its target's bounding box, the width of the box,
+    #   and whether the key's target is the mirror image of the job's target
+    def _key(self, board: Board, agent_options: dict):
+        target = board.values == CellValue.FALSE_NEGATIVE.value
+        xs, ys = np.nonzero(target)
+        if len(xs) == 0:
+            return None, None, None, False
+        x0, y0 = xs.min(), ys.min()
+        crop = target[x0:xs.max() + 1, y0:ys.max() + 1]
+
+        def rows(crop):
+            return ["".join("#" if cell else "." for cell in row) for row in crop.T]
+        mirrored = rows(crop[::-1]) < rows(crop)
+        key = {
+            "target": rows(crop[::-1] if mirrored else crop),
+            "rows_below": int(board.shape[1] - 1 - ys.max()),
+            "false_positives": agent_options["allowable_false_positives"],
+            "false_negatives": agent_options["allowable_false_negatives"],
+            "enforce_gravity": bool(agent_options["enforce_gravity"]),
+            "reduce_Is": bool(agent_options["reduce_Is"]),
+        }
+        return key, (int(x0), int(y0)), crop.shape[0], mirrored
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest() + ".json")
+
+    def _read(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)["solutions"]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    # Returns the cached solutions of a job (as lists of (shape, anchor) tuples) that are solutions on its board, marking its entry as used
+    def lookup(self, board: Board, agent_options: dict):
+        key, (x0, y0), width, mirrored = self._key(board, agent_options)
+        if key is None:
+            return []
+        path = self._path(key)
+        if not os.path.exists(path):
+            return []
+        os.utime(path)
+
+        solutions = []
+        for solution in self._read(path):
+            if mirrored:
+                solution = mirror_placements(solution, width)
+            placements = [((piece_id, rotation_id), (x + x0, y + y0)) for piece_id, rotation_id, x, y in solution]
+            if is_solution(board, placements, agent_options):
+                solutions.append(placements)
+        return solutions
+
+    # Adds a solution of a job (as a list of (shape, anchor) tuples) to its entry, unless it is already there or the entry is full.
+    # The solutions of a target that is its own mirror image are added along with their mirror images.
+    def add(self, board: Board, agent_options: dict, placements: list):
+        key, (x0, y0), width, mirrored = self._key(board, agent_options)
+        if key is None:
+            return
+        solution = [[int(shape[0]), int(shape[1]), int(anchor[0]) - x0, int(anchor[1]) - y0] for shape, anchor in placements]
+        if mirrored:
+            solution = mirror_placements(solution, width)
+        added = [solution]
+        if key["target"] == [row[::-1] for row in key["target"]]:
+            added.append(mirror_placements(solution, width))
+
+        path = self._path(key)
+        is_new = not os.path.exists(path)
+        solutions = self._read(path)
+        changed = False
+        for solution in added:
+            if solution not in solutions and len(solutions) < self.max_solutions:
+                solutions.append(solution)
+                changed = True
+        if not changed:
+            return
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"key": key, "solutions": solutions}, file)
+        os.replace(temp_path, path)
+        if is_new:
+            self._evict()
+
+    # Removes the least recently used entries until there are at most max_entries
+    def _evict(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(paths) <= self.max_entries:
+            return
+        def last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0
+        for path in sorted(paths, key=last_used)[:len(paths) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,99 +1,213 @@
 const { spawn } = require('node:child_process');
 const os = require('node:os');
 const path = require('node:path');
+const { AnimationDecoder } = require('./animationDecoder.cjs');
 
 const EOF = "<EOF>"
 const NUM_ADDED_ROWS = 6;
 
+//Animations are sent by the engine in the packed format, in chunks of this many frames
+const ANIMATION_FORMAT = "packed";
+const ANIMATION_CHUNK_SIZE = 64;
+
+//Seconds between the search statistics sent by the engine for each job
+const STATS_INTERVAL = 5;
+
+//Directory of the engine's solution cache, which lets jobs that were run before send their solutions right away
+const CACHE_DIR = path.join(os.tmpdir(), 'tetrify-cache');
+
 //Determine location of engine dir
 const ENGINE_DIR = path.join(process.env.NODE_ENV ? '.' : process.resourcesPath ?? ".", 'engine')
 
-//An array containing child process objects
-let children = []
+//Maximum number of engine worker processes kept running at once (jobs beyond this wait in the queue)
+const MAX_WORKERS = parseInt(process.env.TETRIFY_MAX_WORKERS ?? "") || os.cpus().length;
+
+//An array of the running worker processes. Each one is an object containing the child process, its message buffer, and its current job (or null when idle)
+let workers = []
+
+//Jobs waiting for an idle worker, in order of arrival
+let jobQueue = []
 
-// A dictionary where the keys are PIDs and the values are strings containing the current message buffer for that child process
-let buffers = {}
+let nextJobId = 0
 
 //These 3 functions assume that the engine is running on local hardware. The client should not use these directly - use the definitions in engineUtils instead.
 function _getNumCores() {
   return os.cpus().length;
 }
 
+//Stops every job (queued or running). The workers are kept running for the next jobs.
 function _stopEngine() {
-  children.forEach((child) => child.kill())
+  [...jobQueue, ...workers.map((worker) => worker.job)].forEach((job) => job?.kill())
 }
 
-function _runEngine(grid, falsePositives, falseNegatives, enforceGravity, reduceWellsAndTowers, onSuccess, onEnd, numThreads = _getNumCores()) {
-  //Add six rows to the top of the grid to allow for block spawning
-  let new_grid = []
-  for (let i = 0; i < NUM_ADDED_ROWS; i++) {
-    new_grid.push(new Array(grid[0].length).fill(false))
+//Starts a long-lived driver process, which runs one job at a time from its stdin
+function _startWorker() {
+  const childProcess = spawn("python3", [path.join(ENGINE_DIR, 'tetrify_driver.py'), "--serve", "--cache", CACHE_DIR]);
+  const worker = { process: childProcess, buffer: "", job: null }
+  workers.push(worker)
+
+  // Event handlers for process output
+  childProcess.stdout.on("data", (msg) => {
+    worker.buffer += msg //Add to buffer
+
+    //Handle every complete message in the buffer
+    let messages = worker.buffer.split(EOF)
+    worker.buffer = messages.pop()
+    for (let msg of messages) {
+      try {
+        _handleMessage(worker, JSON.parse(msg));
+      } catch (e) {
+        console.error(e);
+        console.log(`[${childProcess.pid}] ${msg}`);
+      }
+    }
+  });
+
+  childProcess.stderr.on("data", (data) => {
+    console.error(`[${childProcess.pid}] Error: ${data}`);
+  });
+
+  childProcess.on("close", (code) => {
+    if (code === null) {
+      console.log(`[${childProcess.pid}] Child process interrupted`);
+    } else {
+      console.log(`[${childProcess.pid}] Child process exited with code ${code}`);
+    }
+
+    //Remove this worker, ending its job (if any), and give the queued jobs to the remaining workers
+    workers.splice(workers.indexOf(worker), 1);
+    if (worker.job) {
+      _endJob(worker.job);
+    }
+    _schedule();
+  });
+  return worker;
+}
+
+function _handleMessage(worker, data) {
+  const job = worker.job;
+  const prefix = job && data.job_id === job.id ? `[${worker.process.pid}:${job.id}]` : `[${worker.process.pid}]`
+
+  //Log messages
+  if ("log" in data) {
+    console.log(`${prefix} ${data.log}`)
   }
-  new_grid.push(...grid)
-  grid = new_grid
 
-  let newChildren = []
-  for (let childNum = 0; childNum < numThreads; childNum++) {
-    const childProcess = spawn("python3", [path.join(ENGINE_DIR, 'tetrify_driver.py')]);
-    newChildren.push(childProcess)
-    children.push(childProcess)
-    buffers[childProcess.pid] = ""
+  //Messages about an old job (e.g. one that was cancelled) are ignored
+  if (!job || data.job_id !== job.id) {
+    return;
   }
 
-  for (let childProcess of newChildren) {
-    // Event handlers for process output
-    childProcess.stdout.on("data", (msg) => {
-      buffers[childProcess.pid] += msg //Add to buffer
-      if (msg.includes(EOF)) {
-        msg = buffers[childProcess.pid].replace(EOF, "")
-        buffers[childProcess.pid] = "" //Clear buffer
-        try {
-          let data = JSON.parse(msg);
-
-          //Log messages
-          if ("log" in data) {
-            console.log(`[${childProcess.pid}] ${data.log}`)
-          }
-
-          //Frames (animation finding was successful)
-          if ("frames" in data) {
-            console.log(`[${childProcess.pid}] Animation found`);
-            onSuccess(data.frames);
-          }
-        } catch (e) {
-          console.error(e);
-          console.log(`[${childProcess.pid}] ${msg}`);
-        }
+  //Frames (animation finding was successful, or found a better approximation)
+  if ("frames" in data) {
+    console.log(`${prefix} ${data.approximate ? "Approximation" : "Animation"} found`);
+    _deliverFrames(job, data.frames, data.approximate);
+  }
+
+  //A chunk of a compact animation, which is either passed on as-is (keeping its approximate flag) or decoded (and delivered once complete)
+  if ("animation" in data) {
+    if (job.onAnimationMessage) {
+      job.onAnimationMessage(data.approximate ? { animation: data.animation, approximate: true } : { animation: data.animation });
+    } else {
+      const frames = job.decoder.add(data.animation);
+      if (frames) {
+        console.log(`${prefix} ${data.approximate ? "Approximation" : "Animation"} found`);
+        _deliverFrames(job, frames, data.approximate);
       }
-    });
+    }
+  }
 
-    childProcess.stderr.on("data", (data) => {
-      console.error(`[${childProcess.pid}] Error: ${data}`);
-    });
+  //Search statistics, which are passed on if onStats was given (and logged otherwise)
+  if ("stats" in data) {
+    if (job.onStats) {
+      job.onStats(data.stats);
+    } else {
+      console.log(`${prefix} ${data.stats.nodes} nodes (${Math.round(data.stats.nodes_per_second)}/s), depth ${data.stats.max_depth}, best partial score ${data.stats.best_partial_score}`);
+    }
+  }
 
-    childProcess.on("close", (code) => {
-      if (code === null) {
-        console.log(`[${childProcess.pid}] Child process interrupted`);
-      } else {
-        console.log(`[${childProcess.pid}] Child process exited with code ${code}`);
-      }
+  //The job is over, so this worker can take the next one
+  if ("done" in data) {
+    console.log(`${prefix} Job ${data.done}`);
+    worker.job = null;
+    _endJob(job);
+    _schedule();
+  }
+}
+
+//Gives the frames of a solution to onSuccess, and those of an approximation to onApproximation (if it was given, and drops them otherwise)
+function _deliverFrames(job, frames, approximate) {
+  if (!approximate) {
+    job.onSuccess(frames);
+  } else if (job.onApproximation) {
+    job.onApproximation(frames);
+  }
+}
 
-      //Remove this child from the list of children and buffer dictionary
-      children.splice(children.indexOf(childProcess), 1);
-      newChildren.splice(newChildren.indexOf(childProcess), 1);
-      delete buffers[childProcess.pid];
+function _endJob(job) {
+  if (!job.ended) {
+    job.ended = true;
+    job.onEnd();
+  }
+}
 
-      //Trigger end event if no more children FROM THIS SESSION are running
-      if (newChildren.length <= 0) {
-        onEnd();
+//Gives queued jobs to idle workers, starting new workers while there are fewer than MAX_WORKERS
+function _schedule() {
+  while (jobQueue.length > 0) {
+    let worker = workers.find((worker) => worker.job === null);
+    if (!worker) {
+      if (workers.length >= MAX_WORKERS) {
+        return;
       }
-    });
+      worker = _startWorker();
+    }
+    const job = jobQueue.shift();
+    worker.job = job;
+    worker.process.stdin.write(JSON.stringify({ job_id: job.id, job: job.config }) + "\n");
+  }
+}
 
-    //Send the data over stdin
-    childProcess.stdin.write(JSON.stringify({ grid: grid, false_positives: falsePositives, false_negatives: falseNegatives, enforce_gravity: enforceGravity, reduce_Is: reduceWellsAndTowers }));
-    childProcess.stdin.end();
+//Queues a job and returns a handle for it, whose kill() stops the job (onEnd is still called once it has stopped).
+//If onAnimationMessage is given, it receives the compact animation messages as they arrive (to be decoded by an AnimationDecoder elsewhere) instead of onSuccess receiving frames.
+//If onStats is given, it receives the search statistics sent every STATS_INTERVAL seconds.
+//If anytimeSeconds is given, a job that has not found an exact solution after that many seconds sends its best approximations instead (until it finds one),
+//  which are given to onApproximation rather than onSuccess (compact animation messages of approximations have "approximate": true).
+function _runEngine(grid, falsePositives, falseNegatives, enforceGravity, reduceWellsAndTowers, onSuccess, onEnd, numThreads = _getNumCores(), timeoutSeconds = undefined, onAnimationMessage = undefined, onStats = undefined, anytimeSeconds = undefined, onApproximation = undefined) {
+  //Add six rows to the top of the grid to allow for block spawning
+  let new_grid = []
+  for (let i = 0; i < NUM_ADDED_ROWS; i++) {
+    new_grid.push(new Array(grid[0].length).fill(false))
+  }
+  new_grid.push(...grid)
+  grid = new_grid
+
+  //The job's driver splits the search across numThreads worker processes of its own
+  const job = {
+    id: nextJobId++,
+    config: { grid: grid, false_positives: falsePositives, false_negatives: falseNegatives, enforce_gravity: enforceGravity, reduce_Is: reduceWellsAndTowers, num_workers: numThreads, timeout: timeoutSeconds, animation_format: ANIMATION_FORMAT, animation_chunk_size: ANIMATION_CHUNK_SIZE, stats_interval: STATS_INTERVAL, anytime_seconds: anytimeSeconds, split_regions: true },
+    onSuccess: onSuccess,
+    onApproximation: onApproximation,
+    onEnd: onEnd,
+    onAnimationMessage: onAnimationMessage,
+    onStats: onStats,
+    decoder: new AnimationDecoder(),
+    ended: false,
+    kill: () => {
+      const queueIndex = jobQueue.indexOf(job);
+      if (queueIndex >= 0) {
+        jobQueue.splice(queueIndex, 1);
+        _endJob(job);
+        return;
+      }
+      const worker = workers.find((worker) => worker.job === job);
+      if (worker) {
+        worker.process.stdin.write(JSON.stringify({ cancel: job.id }) + "\n");
+      }
+    }
   }
-  return newChildren;
+  jobQueue.push(job);
+  _schedule();
+  return job;
 }
 
-module.exports = {_runEngine, _stopEngine, _getNumCores}
\ No newline at end of file
+module.exports = {_runEngine, _stopEngine, _getNumCores}
@@ -0,0 +1,143 @@
+import os, sys, json, time, random, argparse
+import multiprocessing as mp
+
+# Tetrifies many grids in one run, without a driver process (and its imports) for each one.
+#
+#   python tetrify_batch.py <input> <output_dir> [--max-solutions N] [--time-limit S] [--animations packed|delta|frames|none] [--processes N] [--seed N]
+#
+# The input is either a directory of job files (*.json, each with the id of its file name), or a JSONL file with one job per line
+#   (each with the id given by its "id", or else by its line number). Each job is the same JSON as a single job of tetrify_driver,
+#   of which only the board and the agent's options are used (it is always searched serially by SearchEngine, without the solution cache),
+#   and it may give its own "max_solutions" and "time_limit". A job that asks for any other search ends in an error (see check_options).
+# The jobs are spread over a pool of processes (one per core by default), each running one job at a time until it has found max_solutions solutions
+#   or has run for time_limit seconds (like the stop conditions of the UI), or its search is over.
+# Each job's result is written to <output_dir>/<id>.json as compact JSON:
+#   {"id": ..., "status": "solved" | "timeout" | "exhausted" | "error", "seconds": ..., "nodes": ..., "solutions": [{"placements": [[piece_id, rotation_id, x, y], ...], "animation": ...}, ...]}
+#   where each animation is in the chosen format (see animation_codec), and is left out with "none".
+# Results are written as soon as each job is over, so a batch that is interrupted carries on where it left off when it is run again:
+#   the jobs that already have results are skipped, except for those that ended in an error.
+
+# Limits of the jobs that do not give their own
+DEFAULT_MAX_SOLUTIONS = 10
+DEFAULT_TIME_LIMIT = 60
+
+# Returns the (id, job) of every job in the input directory or JSONL file, in order
+def read_jobs(path):
+    if os.path.isdir(path):
+        jobs = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".json"):
+                with open(os.path.join(path, name)) as file:
+                    jobs.append((name[:-len(".json")], json.load(file)))
+        return jobs
+
+    jobs = []
+    with open(path) as file:
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                job = json.loads(line)
+                jobs.append((str(job.get("id", line_number)), job))
+    return jobs
+
+def result_path(output_dir, job_id):
+    return os.path.join(output_dir, job_id.replace(os.sep, "_") + ".json")
+
+# Returns whether a job already has a result that does not need to be run again
+def has_result(output_dir, job_id):
+    try:
+        with open(result_path(output_dir, job_id)) as file:
+            return json.load(file)["status"] != "error"
+    except (OSError, ValueError, KeyError):
+        return False
+
+# Raises a ValueError if the job asks for an option of tetrify_driver that a batch does not support, rather than silently searching without it
+def check_options(job, num_workers):
+    if job.get("search", "dfs") != "dfs":
+        raise ValueError(f"Batch jobs do not support the {job['search']} search")
+    if num_workers > 1:
+        raise ValueError("Batch jobs do not support multiple workers")
+    if job.get("split_regions", False):
+        raise ValueError("Batch jobs do not support split_regions")
+    if job.get("cache") is not None:
+        raise ValueError("Batch jobs do not support the solution cache")
+    if job.get("anytime_seconds") is not None or job.get("anytime_nodes") is not None:
+        raise ValueError("Batch jobs do not support an anytime budget")
+
+# Runs one job until it is solved, times out or its search is over, and returns its result
+def run_job(job_id, job, max_solutions, time_limit, animation_format):
+    from tetris_agent import TetrisAgent
+    from tetris_search import SearchEngine
+    from tetris_env import SimulationResult
+    from tetrify_driver import parse_job
+
+    board, agent_options, num_workers = parse_job(job)
+    check_options(job, num_workers)
+    max_solutions = job.get("max_solutions", max_solutions)
+    time_limit = job.get("time_limit", time_limit)
+    agent = TetrisAgent(board.shape, **agent_options)
+    solutions = []
+    start = time.perf_counter()
+    engine = SearchEngine(agent, board, solutions.append)
+    result = engine.run(lambda: len(solutions) >= max_solutions or time.perf_counter() - start >= time_limit)
+    seconds = time.perf_counter() - start
+
+    if result != SimulationResult.NOT_DONE:
+        status = "exhausted"
+    else:
+        status = "solved" if len(solutions) >= max_solutions else "timeout"
+
+    # The animations are built once the search is over, so they do not count toward the time limit
+    animator = TetrisAgent(board.shape, **{**agent_options, "animation_format": animation_format if animation_format != "none" else "frames"}, transposition_table_size=0)
+    results = []
+    for placements in solutions:
+        solution = {"placements": [[*shape, *anchor] for shape, anchor in placements]}
+        if animation_format != "none":
+            animation = animator.build_animation_from_placements(board.copy(), placements)
+            solution["animation"] = animation if animation_format == "frames" else list(animation)
+        results.append(solution)
+    return {"id": job_id, "status": status, "seconds": round(seconds, 3), "nodes": engine.nodes_expanded, "solutions": results}
+
+# Runs one job in a pool process, and writes its result (or its error) to its file. Returns (id, status, number of solutions, seconds).
+def _run_and_save(task):
+    job_id, job, output_dir, max_solutions, time_limit, animation_format, seed = task
+    if seed is not None:
+        random.seed(f"{seed}:{job_id}")
+    try:
+        result = run_job(job_id, job, max_solutions, time_limit, animation_format)
+    except Exception as e:
+        result = {"id": job_id, "status": "error", "error": repr(e)}
+
+    path = result_path(output_dir, job_id)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(result, file, separators=(",", ":"))
+    os.replace(temp_path, path)
+    return job_id, result["status"], len(result.get("solutions", [])), result.get("seconds")
+
+def main():
+    parser = argparse.ArgumentParser(description="Tetrify many grids in one run")
+    parser.add_argument("input", help="Directory of job files (*.json), or JSONL file of jobs")
+    parser.add_argument("output", help="Directory to write each job's result to")
+    parser.add_argument("--max-solutions", type=int, default=DEFAULT_MAX_SOLUTIONS, help="Solutions after which a job stops (unless it gives its own \"max_solutions\")")
+    parser.add_argument("--time-limit", type=float, default=DEFAULT_TIME_LIMIT, help="Seconds after which a job stops (unless it gives its own \"time_limit\")")
+    parser.add_argument("--animations", choices=["packed", "delta", "frames", "none"], default="packed", help="Format of the animations saved with the solutions")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes (the number of cores by default)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the searches (each job's is derived from it and the job's id)")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = read_jobs(args.input)
+    pending = [(job_id, job) for job_id, job in jobs if not has_result(args.output, job_id)]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done", file=sys.stderr)
+
+    tasks = [(job_id, job, args.output, args.max_solutions, args.time_limit, args.animations, args.seed) for job_id, job in pending]
+    counts = {}
+    with mp.get_context("spawn").Pool(args.processes) as pool:
+        for done, (job_id, status, num_solutions, seconds) in enumerate(pool.imap_unordered(_run_and_save, tasks), 1):
+            counts[status] = counts.get(status, 0) + 1
+            details = "" if seconds is None else f", {num_solutions} solutions in {seconds:.1f}s"
+            print(f"[{done}/{len(tasks)}] {job_id}: {status}{details}", file=sys.stderr)
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "Nothing to do", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,393 @@
-import sys, json
+import sys, os, json, argparse, signal, time, threading, queue, itertools
 import numpy as np
-from tetris_env import board_from_grid, print_board, count_stragglers
-from tetris_agent import TetrisAgent
+from tetris_env import board_from_grid, SimulationResult
+from tetris_agent import TetrisAgent, agent_features
+from tetris_search import SearchEngine
+from parallel_search import run_parallel
+from beam_search import BeamSearch, DEFAULT_BEAM_WIDTH
+from region_search import independent_regions, run_regions
+from animation_builder import AnimationBuilder
+from search_stats import SearchStats, reporting, profiled
+from anytime import AnytimeTracker, anytime_stop, run_anytime_parallel, search_approximations
+from weight_profiles import PROFILES_PATH, load_parameters
+from solution_cache import SolutionCache, DEFAULT_MAX_ENTRIES
 from utils import log, send
 
-# Read JSON input
-for line in sys.stdin:
-  in_msg = json.loads(line)
-
-# Parse JSON input
-arr = np.asarray(in_msg["grid"])
-false_positives = in_msg["false_positives"]
-false_negatives = in_msg["false_negatives"]
-enforce_gravity = in_msg["enforce_gravity"]
-reduce_Is = in_msg["reduce_Is"]
-log("Running...")
-
-def send_frames(animation):
-  data = {}
-  data["frames"] = animation
-  send(data)
-
-# Build agent and run simulation
-sys.setrecursionlimit(2000)
-board = board_from_grid(arr)
-agent = TetrisAgent(board.shape, false_positives, false_negatives, enforce_gravity, reduce_Is)
-result, animation = agent.run_simulation(board, board, on_success=send_frames)
\ No newline at end of file
+# Ids of compact animations, which tell apart the chunks of animations sent by this process
+animation_ids = itertools.count()
+
+# Solution cache directory of jobs that do not give their own "cache" (set by the --cache option), and the number of entries kept in it
+cache_directory = None
+cache_entries = DEFAULT_MAX_ENTRIES
+
+# Returns a function that sends each animation it is given (built in the given format) along with the given fields.
+# Full frames are sent as {"frames": [...]}, and each chunk of a compact animation is sent as {"animation": {"id": ..., ...}}.
+def animation_sender(animation_format, **fields):
+  def send_animation(animation):
+    if animation_format == "frames":
+      send({**fields, "frames": animation})
+      return
+    animation_id = next(animation_ids)
+    for chunk in animation:
+      send({**fields, "animation": {"id": animation_id, **chunk}})
+  return send_animation
+
+# Parses a JSON job into its board, the options for its TetrisAgent, and its number of worker processes.
+# The agent's feature weights are the job's "parameters" if it has them, or else the tuned profile for its configuration
+#   in its "weight_profiles" file (PROFILES_PATH by default, see tune_weights), if there is one (see load_parameters).
+def parse_job(in_msg):
+  arr = np.asarray(in_msg["grid"])
+  parameters = in_msg.get("parameters")
+  if parameters is None:
+    parameters = load_parameters(agent_features(in_msg["reduce_Is"]), in_msg["false_positives"], in_msg["false_negatives"], in_msg["enforce_gravity"], in_msg["reduce_Is"], in_msg.get("weight_profiles", PROFILES_PATH))
+  agent_options = {
+    "allowable_false_positives": in_msg["false_positives"],
+    "allowable_false_negatives": in_msg["false_negatives"],
+    "enforce_gravity": in_msg["enforce_gravity"],
+    "reduce_Is": in_msg["reduce_Is"],
+    "animation_format": in_msg.get("animation_format", "frames"),
+    "animation_chunk_size": in_msg.get("animation_chunk_size"),
+    "prune_bounds": in_msg.get("prune_bounds", True),
+    "parameters": parameters,
+  }
+  num_workers = in_msg.get("num_workers", 1)
+  return board_from_grid(arr), agent_options, num_workers
+
+# Returns the function to give each solution of a job to (as its placements), which sends it along with the given fields.
+# What is sent depends on the job's "animations" mode:
+#   "inline" builds and sends the animation right away (pausing the search until it is sent),
+#   "background" (the default) leaves the animation to the builder (keyed by the job_id field, if any),
+#   "on_demand" only sends {"solution": {"id": ..., "placements": [[piece_id, rotation_id, x, y], ...]}}, whose animation can be requested later (see serve).
+def solution_handler(in_msg, builder: AnimationBuilder, **fields):
+  board, agent_options, _ = parse_job(in_msg)
+  mode = in_msg.get("animations", "background")
+  if mode not in ("inline", "background", "on_demand"):
+    raise ValueError(f"Unknown animations mode: {mode}")
+
+  # The animations are built by an agent of their own, since the search's agent may be in another process
+  agent = TetrisAgent(board.shape, **agent_options, transposition_table_size=0)
+  send_animation = animation_sender(agent.animation_format, **fields)
+  solution_ids = itertools.count()
+  def on_success(placements):
+    if mode == "inline":
+      send_animation(agent.build_animation_from_placements(board.copy(), placements))
+    elif mode == "background":
+      builder.submit(agent, board, placements, send_animation, fields.get("job_id"))
+    else:
+      send({**fields, "solution": {"id": next(solution_ids), "placements": [[*shape, *anchor] for shape, anchor in placements]}})
+  return on_success
+
+# Wraps the solution handler of a job to use the job's "cache" directory (cache_directory by default, and none if it is null, see SolutionCache).
+# The job's cached solutions are given to on_success right away (logging how many there are, along with the given fields), and every solution
+#   found afterwards is added to the cache and given to on_success, unless it is one of the cached solutions.
+def cached_solution_handler(in_msg, on_success, **fields):
+  directory = in_msg.get("cache", cache_directory)
+  if directory is None:
+    return on_success
+  cache = SolutionCache(directory, cache_entries)
+  board, agent_options, _ = parse_job(in_msg)
+  sent = set()
+  def on_cached_success(placements):
+    key = tuple((int(shape[0]), int(shape[1]), int(anchor[0]), int(anchor[1])) for shape, anchor in placements)
+    if key in sent:
+      return
+    sent.add(key)
+    cache.add(board, agent_options, placements)
+    on_success(placements)
+
+  cached = cache.lookup(board, agent_options)
+  if cached:
+    log(f"Sending {len(cached)} cached solutions", **fields)
+  for placements in cached:
+    on_cached_success(placements)
+  return on_cached_success
+
+# Queues the animation of a solution sent by the "on_demand" mode, to be sent along with the given fields
+def request_animation(in_msg, placements, builder: AnimationBuilder, **fields):
+  board, agent_options, _ = parse_job(in_msg)
+  agent = TetrisAgent(board.shape, **agent_options, transposition_table_size=0)
+  placements = [((piece_id, rotation_id), (x, y)) for piece_id, rotation_id, x, y in placements]
+  builder.submit(agent, board, placements, animation_sender(agent.animation_format, **fields))
+
+# Turns on the agent's instrumentation if the job has a "stats_interval" (in seconds), and returns should_stop wrapped to send
+#   {"stats": {...}} (along with the given fields) every interval. Otherwise, should_stop is returned as it is.
+def instrument_job(in_msg, agent: TetrisAgent, should_stop=None, **fields):
+  stats_interval = in_msg.get("stats_interval")
+  if stats_interval is None:
+    return should_stop
+  agent.instrument(SearchStats())
+  return reporting(stats_interval, lambda: send({**fields, "stats": agent.stats.to_dict()}), should_stop)
+
+# Returns the AnytimeTracker of a job with an "anytime_seconds" or "anytime_nodes" budget (or None for any other job),
+#   which sends its approximations like solutions, but with "approximate": true added to their messages
+def anytime_tracker(in_msg, builder: AnimationBuilder, **fields):
+  if in_msg.get("anytime_seconds") is None and in_msg.get("anytime_nodes") is None:
+    return None
+  return AnytimeTracker(solution_handler(in_msg, builder, **fields, approximate=True), in_msg.get("anytime_seconds"), in_msg.get("anytime_nodes"))
+
+# Runs a job with "search": "beam" until its beam search is finished or should_stop() returns True, sending each solution found along with the given fields.
+# Its "beam_width" (DEFAULT_BEAM_WIDTH if not given) is the number of boards kept after each piece (see BeamSearch).
+# The beam search always runs in this process, and has no anytime mode.
+def run_beam_job(in_msg, builder: AnimationBuilder, should_stop=None, **fields):
+  board, agent_options, _ = parse_job(in_msg)
+  agent = TetrisAgent(board.shape, **agent_options, log_fields=fields)
+  on_success = cached_solution_handler(in_msg, solution_handler(in_msg, builder, **fields), **fields)
+  search = BeamSearch(agent, board, on_success, in_msg.get("beam_width", DEFAULT_BEAM_WIDTH))
+  should_stop = instrument_job(in_msg, agent, should_stop, **fields)
+  with profiled(in_msg.get("profile")):
+    result = search.run(should_stop)
+  if agent.stats is not None:
+    send({**fields, "stats": agent.stats.to_dict()})
+  return result
+
+# Runs a job until its search is finished or should_stop() returns True, sending each solution found along with the given fields.
+# The job's "search" is either "dfs" (the default, see SearchEngine) or "beam" (see run_beam_job).
+# A job that uses a solution cache sends its cached solutions first (see cached_solution_handler).
+# A job with "split_regions": true whose target is split by empty columns searches each strip between them on its own (see run_regions),
+#   if its strips are independent (see independent_regions). If the strips give no solutions, the whole board is searched after all.
+#   If it has an anytime budget, its approximations are searched for on the whole board.
+# A job with a "stats_interval" also sends the stats of its search periodically (see instrument_job), and once it is over.
+# The logs about the job's search (including those of its transposition tables, in every process) are sent along with the given fields.
+# A job with a "profile" path is profiled with cProfile, and its profile is written to that path (or, with multiple workers, to the path followed by each worker's index).
+# A job with an anytime budget ("anytime_seconds" and/or "anytime_nodes", of which workers only use the seconds) sends its best approximation
+#   if the budget runs out before it finds a solution, followed by every better one that its search finds for as long as the job keeps running:
+#   the search carries on with a relaxed pruning bound (see pruning_false_negatives), or, if it was over before the budget ran out,
+#   search_approximations searches again from the root. Jobs without a budget have no anytime mode.
+def run_job(in_msg, builder: AnimationBuilder, should_stop=None, **fields):
+  search = in_msg.get("search", "dfs")
+  if search == "beam":
+    return run_beam_job(in_msg, builder, should_stop, **fields)
+  if search != "dfs":
+    raise ValueError(f"Unknown search: {search}")
+
+  board, agent_options, num_workers = parse_job(in_msg)
+  agent_options = {**agent_options, "log_fields": fields}
+  on_success = solution_handler(in_msg, builder, **fields)
+  tracker = anytime_tracker(in_msg, builder, **fields)
+  if tracker is not None:
+    on_solution = on_success
+    def on_success(placements):
+      tracker.solved = True
+      on_solution(placements)
+  on_success = cached_solution_handler(in_msg, on_success, **fields)
+  stopped = lambda: should_stop is not None and should_stop()
+
+  stats = None
+  result = None
+  regions = independent_regions(board, agent_options) if in_msg.get("split_regions", False) else None
+  if regions is not None:
+    search_stop = should_stop
+    if in_msg.get("stats_interval") is not None and num_workers <= 1:
+      stats = SearchStats()
+      search_stop = reporting(in_msg["stats_interval"], lambda: send({**fields, "stats": stats.to_dict()}), should_stop)
+    if tracker is not None:
+      region_stop = search_stop
+      search_stop = lambda: (region_stop is not None and region_stop()) or (not tracker.solved and tracker.expired())
+    num_merged = 0
+    def on_merged(placements):
+      nonlocal num_merged
+      num_merged += 1
+      on_success(placements)
+    with profiled(in_msg.get("profile")):
+      result = run_regions(board, agent_options, regions, on_merged, num_workers, search_stop, stats)
+    if result == SimulationResult.FAILURE and num_merged == 0 and not stopped():
+      # A solution may need to move pieces through the columns of other strips, which the strips cannot find on their own
+      log("The strips have no solutions, so the whole board is searched", **fields)
+      result = None
+    elif result == SimulationResult.NOT_DONE and not stopped():
+      # The budget ran out, and the strips have no approximations of the whole board, so the whole board is searched for them
+      result = None
+
+  num_nodes = 0
+  if result is None and num_workers > 1:
+    on_stats = lambda stats: send({**fields, "stats": stats})
+    if tracker is not None:
+      result = run_anytime_parallel(board, agent_options, tracker, on_success, num_workers, should_stop, in_msg.get("stats_interval"), on_stats, in_msg.get("profile"))
+    else:
+      result = run_parallel(board, agent_options, on_success, num_workers, should_stop, in_msg.get("stats_interval"), on_stats, in_msg.get("profile"))
+  elif result is None:
+    agent = TetrisAgent(board.shape, **agent_options)
+    engine = SearchEngine(agent, board, on_success)
+    search_stop = instrument_job(in_msg, agent, should_stop, **fields)
+    if tracker is not None:
+      search_stop = anytime_stop(engine, tracker, board, agent_options, search_stop)
+    with profiled(in_msg.get("profile")):
+      result = engine.run(search_stop)
+    if tracker is not None and engine.best is not None:
+      tracker.offer(*engine.best)
+    if agent.transposition_table is not None:
+      agent.transposition_table.log_stats()
+    stats = agent.stats
+    num_nodes = engine.nodes_expanded
+
+  if tracker is not None and tracker.expired(num_nodes):
+    tracker.check(num_nodes)
+  elif tracker is not None and not tracker.solved and not stopped():
+    profile = in_msg.get("profile") and in_msg["profile"] + ".anytime"
+    with profiled(profile if num_workers <= 1 else None):
+      result = search_approximations(board, agent_options, tracker, on_success, should_stop, stats, num_workers, in_msg.get("stats_interval"),
+                                     lambda stats: send({**fields, "stats": stats}), profile)
+  if stats is not None:
+    send({**fields, "stats": stats.to_dict()})
+  return result
+
+# Runs many jobs, one at a time, for as long as stdin is open. Each line of stdin is one of these commands:
+#   {"job_id": ..., "job": {...}} queues a job (the same JSON as a single job, plus an optional "timeout" in seconds)
+#   {"cancel": job_id} stops a queued or running job
+#   {"animate": {"job_id": ..., "job": {...}, "placements": [...]}} sends the animation of a solution sent by a job in the "on_demand" mode
+#     (with the given job_id, which may be any value), without waiting for the running job
+# Every message sent about a job includes its job_id, and the last one for each job is {"job_id": ..., "done": <status>},
+#   where the status is "finished", "cancelled", "timeout" or "error".
+def serve():
+  jobs = queue.Queue()
+
+  # Ids of the jobs that are queued or running, and of those of them that were cancelled (a cancel for any other id is ignored)
+  active = set()
+  cancelled = set()
+  job_ids_lock = threading.Lock()
+  builder = AnimationBuilder()
+
+  # Commands are read on another thread, so that a job can be cancelled while it runs.
+  # The thread reads its own copy of stdin, since forked worker processes close sys.stdin (which would wait forever for the thread's lock on it).
+  commands = open(os.dup(sys.stdin.fileno()))
+  def read_commands():
+    for line in commands:
+      if not line.strip():
+        continue
+      command = json.loads(line)
+      if "cancel" in command:
+        with job_ids_lock:
+          if command["cancel"] in active:
+            cancelled.add(command["cancel"])
+      elif "animate" in command:
+        request = command["animate"]
+        try:
+          request_animation(request["job"], request["placements"], builder, job_id=request["job_id"])
+        except Exception as e:
+          send({"job_id": request.get("job_id"), "log": f"Error: {e!r}"})
+      else:
+        with job_ids_lock:
+          active.add(command["job_id"])
+        jobs.put(command)
+    jobs.put(None)
+  threading.Thread(target=read_commands, daemon=True).start()
+
+  log("Ready")
+  while (command := jobs.get()) is not None:
+    job_id = command["job_id"]
+    job = command["job"]
+    status = "finished"
+    if job_id in cancelled:
+      status = "cancelled"
+    else:
+      timeout = job.get("timeout")
+      deadline = None if timeout is None else time.monotonic() + timeout
+      def should_stop():
+        nonlocal status
+        if job_id in cancelled:
+          status = "cancelled"
+        elif deadline is not None and time.monotonic() >= deadline:
+          status = "timeout"
+        return status != "finished"
+
+      send({"job_id": job_id, "log": "Running..."})
+      try:
+        run_job(job, builder, should_stop, job_id=job_id)
+      except Exception as e:
+        status = "error"
+        send({"job_id": job_id, "log": f"Error: {e!r}"})
+
+    # Send the animations of the job's solutions before it is done (unless it was cancelled)
+    if status == "cancelled":
+      builder.drop(job_id)
+    builder.wait()
+    builder.forget(job_id)
+    with job_ids_lock:
+      active.discard(job_id)
+      cancelled.discard(job_id)
+    send({"job_id": job_id, "done": status})
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--serve", action="store_true", help="Keep running, and take many jobs over stdin (see serve)")
+  parser.add_argument("--checkpoint", help="File to save the search to periodically, and when the driver is terminated")
+  parser.add_argument("--checkpoint-interval", type=float, default=60, help="Seconds between periodic checkpoints")
+  parser.add_argument("--resume", help="Checkpoint file to resume a saved search from (the job is read from it instead of stdin)")
+  parser.add_argument("--cache", help="Solution cache directory of jobs that do not give their own \"cache\" (see SolutionCache)")
+  parser.add_argument("--cache-entries", type=int, default=DEFAULT_MAX_ENTRIES, help="Number of jobs whose solutions are kept in the cache")
+  parser.add_argument("--profile", help="File to write a cProfile profile of the search to (the same as the job's \"profile\")")
+  args = parser.parse_args()
+  global cache_directory, cache_entries
+  cache_directory, cache_entries = args.cache, args.cache_entries
+
+  if args.serve:
+    # Exit normally when terminated, so that any worker processes are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve()
+    return
+
+  # Read JSON input (a resumed search keeps its job in the checkpoint)
+  checkpoint = None
+  if args.resume:
+    checkpoint = SearchEngine.load_checkpoint(args.resume)
+    in_msg = checkpoint["metadata"]
+  else:
+    for line in sys.stdin:
+      in_msg = json.loads(line)
+  if args.profile:
+    in_msg["profile"] = args.profile
+  log("Resuming..." if checkpoint else "Running...")
+
+  checkpoint_path = args.checkpoint or args.resume
+  if checkpoint_path is None:
+    # Exit normally when terminated, so that any worker processes are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    builder = AnimationBuilder()
+    run_job(in_msg, builder)
+    builder.wait()
+    return
+
+  # Build agent and search engine (only the depth-first search of a single process can be checkpointed)
+  if in_msg.get("search", "dfs") != "dfs":
+    raise ValueError(f"Checkpoints are not supported with the {in_msg['search']} search")
+  board, agent_options, num_workers = parse_job(in_msg)
+  if num_workers > 1:
+    log("Checkpoints are not supported with multiple workers")
+  if in_msg.get("split_regions", False):
+    log("Checkpoints are not supported with split_regions, so the whole board is searched")
+  if in_msg.get("anytime_seconds") is not None or in_msg.get("anytime_nodes") is not None:
+    log("Checkpoints are not supported with an anytime budget, so only exact solutions are searched for")
+  agent = TetrisAgent(board.shape, **agent_options)
+  builder = AnimationBuilder()
+  on_success = cached_solution_handler(in_msg, solution_handler(in_msg, builder))
+  if checkpoint:
+    engine = SearchEngine.resume(agent, board, on_success, checkpoint["search"])
+  else:
+    engine = SearchEngine(agent, board, on_success)
+
+  # Save the search every checkpoint interval, and when asked to terminate
+  terminated = False
+  def on_terminate(signum, frame):
+    nonlocal terminated
+    terminated = True
+  signal.signal(signal.SIGTERM, on_terminate)
+  signal.signal(signal.SIGINT, on_terminate)
+
+  should_stop = instrument_job(in_msg, agent, lambda: terminated or time.monotonic() >= next_checkpoint)
+  next_checkpoint = time.monotonic() + args.checkpoint_interval
+  with profiled(in_msg.get("profile")):
+    while not engine.finished and not terminated:
+      engine.run(should_stop)
+      engine.save_checkpoint(checkpoint_path, in_msg)
+      next_checkpoint = time.monotonic() + args.checkpoint_interval
+  if agent.stats is not None:
+    send({"stats": agent.stats.to_dict()})
+  builder.wait()
+  if terminated:
+    log(f"Search saved to {checkpoint_path}")
+  elif agent.transposition_table is not None:
+    agent.transposition_table.log_stats()
+
+# The guard keeps worker processes that import this module (when they are spawned rather than forked) from running it
+if __name__ == "__main__":
+  main()
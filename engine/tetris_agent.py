@@ -1,19 +1,22 @@
 import numpy as np
 import random
-from tetris_env import TetrisAction, SimulationResult, set_piece, get_shape_grid, is_occupied, has_dropped, rotated, count_stragglers, count_wells, count_towers, count_false_positives, count_false_negatives, count_buried_false_negatives, pieces, apply_shape, take_action
-from utils import log
+from tetris_env import Board, CellValue, TetrisAction, set_piece, has_dropped, rotated, count_wells, count_towers, count_false_positives, count_false_negatives, count_buried_false_negatives, unreachable_false_negatives, label_islands, apply_shape, take_action, clear_ghosts, get_frame
+from tetris_features import FeatureEvaluator, IslandTracker, Reachability, placed_cells, enumerate_placements
+from tetris_search import SearchEngine
+from animation_codec import ANIMATION_FORMATS, encode_animation
+from transposition import TranspositionTable
 from collections.abc import Callable
 
-# Returns the optimal (ordered) sequence of actions to achieve the desired placement starting from the current state.
+# Returns the straight (rotate, then shift, then drop) sequence of actions to achieve the desired placement starting from the current state.
+# Animations only fall back on it for placements that the actions cannot reach from the spawn state (see Reachability).
 def generate_action_sequence(placement, board, shape, anchor):
     sequence = []
     placement_shape, placement_anchor = placement
-    placement_shape_grid = get_shape_grid(placement_shape)
     
     # If the orientation of the shape does not match, then rotate
-    while not np.array_equal(get_shape_grid(shape), placement_shape_grid):
+    while shape != placement_shape:
         # Determine which way to rotate
-        if np.array_equal(get_shape_grid(rotated(shape, False)), placement_shape_grid):
+        if rotated(shape, False) == placement_shape:
             sequence.append(TetrisAction.ROTATE_LEFT)
             shape = rotated(shape, False)
         else:
@@ -38,8 +41,16 @@ def generate_action_sequence(placement, board, shape, anchor):
     return sequence
 
 
+# Returns the list of features that an agent evaluates boards with
+def agent_features(reduce_Is=True):
+    features = [count_false_positives, count_false_negatives, count_buried_false_negatives]
+    if reduce_Is:
+        features = [*features, count_wells, count_towers]
+    return features
+
+
 class TetrisAgent:
-    def __init__(self, board_shape, allowable_false_positives: int, allowable_false_negatives: int, enforce_gravity=True, reduce_Is=True):
+    def __init__(self, board_shape, allowable_false_positives: int, allowable_false_negatives: int, enforce_gravity=True, reduce_Is=True, transposition_table_size=200000, animation_format="frames", animation_chunk_size=None, prune_bounds=True, parameters=None, log_fields=None):
         self.board_width = board_shape[0]
         self.board_height = board_shape[1]
         self.current_state = (None, None, None, None)
@@ -47,176 +58,183 @@ class TetrisAgent:
         self.allowable_false_negatives = allowable_false_negatives
         self.enforce_gravity = enforce_gravity
 
-        # List of features to be used to evaluate state values
-        self.features: list = [count_false_positives, count_false_negatives, count_buried_false_negatives]
-        if reduce_Is:
-            self.features = [*self.features, count_wells, count_towers]
-        
-        # Parameters (each feature is weighted equally negatively)
-        # NOTE - If any ML were to be introduced to this project, optimizing these weights would be a good starting point
-        self.parameters = [-1 for _ in self.features]
-
-    def get_features(self, _board):
-        # Copy the board
-        board = np.copy(_board)
+        # Whether nodes are also pruned by the lower bounds of cannot_succeed (which never prune a solution)
+        self.prune_bounds = prune_bounds
 
+        # List of features to be used to evaluate state values
+        self.features: list = agent_features(reduce_Is)
+
+        # Parameters (each feature is weighted equally negatively, unless tuned weights are given - see tune_weights)
+        if parameters is None:
+            parameters = [-1 for _ in self.features]
+        if len(parameters) != len(self.features):
+            raise ValueError(f"Expected {len(self.features)} parameters, got {len(parameters)}")
+        self.parameters = list(parameters)
+
+        # Fields sent along with the logs about the agent's searches (such as the job_id of their job)
+        self.log_fields = log_fields or {}
+
+        # Boards already searched without success (disabled if the size is 0)
+        self.transposition_table = TranspositionTable(board_shape, transposition_table_size, self.log_fields) if transposition_table_size > 0 else None
+        self.num_solutions = 0
+
+        # How animations are built (see animation_codec)
+        if animation_format not in ANIMATION_FORMATS:
+            raise ValueError(f"Unknown animation format: {animation_format}")
+        self.animation_format = animation_format
+        self.animation_chunk_size = animation_chunk_size
+
+        # Counters and timings of the search (only collected once instrument is called)
+        self.stats = None
+
+    # Turns on instrumentation, which adds the counters and timings of every search by this agent to the given SearchStats
+    def instrument(self, stats):
+        if self.stats is None:
+            self.island_counts = stats.timed("island_counts", self.island_counts)
+            self.cannot_succeed = stats.timed("cannot_succeed", self.cannot_succeed)
+        self.stats = stats
+
+    def get_features(self, board):
         # Given a board, return the values of each feature of that board
         return [feature(board) for feature in self.features]
 
 
     def state_value(self, board):
         # Given a board and a list of feature weights (parameters), return the summed "goodness" value of the board
-        return sum([feature*weight for feature, weight in zip(self.get_features(board), self.parameters)])
+        return self.feature_value(self.get_features(board))
+
+    def feature_value(self, features):
+        # Given a list of feature values, return the summed "goodness" value they represent
+        return sum([int(feature)*weight for feature, weight in zip(features, self.parameters)])
+
+    # Returns the value of the board after placing the shape at the anchor, updating only the affected columns of the evaluator's features.
+    # This always matches state_value of the resulting board.
+    def placement_value(self, evaluator: FeatureEvaluator, board, shape, anchor):
+        cells = placed_cells(board, shape, anchor)
+        return self.feature_value(evaluator.features_after(board, np.array([[x for x, _ in cells]]), np.array([[y for _, y in cells]]))[:, 0])
     
-    # Returns a list of all possible placements for the given shape on the given board.
+    # Returns a list of all possible placements for the given piece on the given board.
     # Placements are given as a tuple (score, shape, anchor) where those values are the position for the piece and the corresponding score for that position, as decided by this agent
-    def get_scored_placements(self, _board, shape):
-        placements = []
+    def get_scored_placements(self, board, piece_id, evaluator: FeatureEvaluator = None, islands: IslandTracker = None):
+        return self.get_all_scored_placements(board, [piece_id], evaluator, islands)
 
-        # For each orientation of the piece...
-        prev_orientations = [] # Keep track of previous orientations to check for duplicates
-        for ori in range(4): # Max 4 orientations per shape
-            # Check if this orientation has already been seen
-            if np.any([np.array_equal(get_shape_grid(shape), prev_shape_grid) for prev_shape_grid in prev_orientations]):
-                # This orientation has been seen before (therefore all unique orientations have been seen), so do not continue checking new orientations.
-                break
-            prev_orientations.append(get_shape_grid(shape))
-            
-            # For each possible anchor column...
-            for x in range(self.board_width):
-                board = np.copy(_board)
-
-                # Check if this is a valid placement
-                start_height = abs(min(_y for _, _y in shape))
-                if not is_occupied(shape, (x, start_height), board):
-                    # This is valid placement. Simulate dropping the piece
-                    if self.enforce_gravity:
-                        # Gravity is enforced, so hard dropping is acceptable
-                        shape, (x,y) = take_action(shape, (x, start_height-1), board, TetrisAction.HARD_DROP)
-                    
-                        # Successfully hallucinated the dropping of the piece. Evaluate the value of this new board
-                        board_val = self.state_value(board)
-
-                        # Add this position and its score to output array iff its placement would not cause failure
-                        if not self.did_fail(board):
-                            placements.append((board_val, shape, (x,y)))
-                    else:
-                        # Add a placement for every possible height of this piece (gravity not enforced)
-                        y = start_height-1
-                        while not has_dropped(shape, (x,y), board):
-                            y += 1
-                            apply_shape(shape, (x,y), board, True)
-
-                            # Successfully hallucinated the dropping of the piece. Evaluate the value of this new board
-                            board_val = self.state_value(board)
-
-                            # Add this position and its score to output array iff its placement would not cause failure
-                            if not self.did_fail(board):
-                                placements.append((board_val, shape, (x,y)))
-
-                            # Reset board (must be done here, BEFORE while condition is checked)
-                            board = np.copy(_board)
-            # Rotate the shape
-            shape = rotated(shape)
-        # log(len(placements))
-        return placements
-    
-    def did_fail(self, board):
-        num_stragglers, num_needed_false_positives = count_stragglers(board)
-        num_false_positives = count_false_positives(board)
-        return num_false_positives > self.allowable_false_positives or (num_false_positives + num_needed_false_positives > self.allowable_false_positives and num_stragglers > self.allowable_false_negatives)
+    # Returns the scored placements of every piece in piece_order, in that order (see get_scored_placements).
+    # Every landing position is enumerated in one pass, and the resulting boards are all scored together without copying the board.
+    def get_all_scored_placements(self, board, piece_order, evaluator: FeatureEvaluator = None, islands: IslandTracker = None):
+        if evaluator is None:
+            evaluator = FeatureEvaluator(self.features, board)
+        if islands is None:
+            islands = IslandTracker(board)
+
+        batch = enumerate_placements(board, piece_order, self.enforce_gravity)
+        scores = np.asarray(self.parameters) @ evaluator.features_after(board, batch.cell_xs, batch.cell_ys)
 
-    def run_simulation(self, orig_board: np.ndarray, _board: np.ndarray, on_success: Callable[[tuple], None], prev_sequence=[], depth=0):
-        # Randomly order the pieces
-        piece_order = random.sample(list(pieces.values()), len(list(pieces.values())))
+        # Placements that add too many false positives fail no matter what, so their islands do not need to be checked
+        num_false_positives = count_false_positives(board) + np.count_nonzero(board.values[batch.cell_xs, batch.cell_ys] == CellValue.EMPTY.value, axis=1)
+        fills_false_negatives = np.any(islands.labels[batch.cell_xs, batch.cell_ys] >= 0, axis=1)
 
-        result = SimulationResult.NOT_DONE
-        sequence = []
         placements = []
-        board = np.copy(_board)
-
-        # Evaluate end condition
-        result = SimulationResult.FAILURE if self.did_fail(board) else SimulationResult.NOT_DONE if count_false_negatives(board) > self.allowable_false_negatives else SimulationResult.SUCCESS
-
-        if result == SimulationResult.NOT_DONE:
-            # Step 1: Determine the scores for all possible placements for all pieces
-            for piece in piece_order:
-                # Determine all possible placements and their scores
-                placements.extend(self.get_scored_placements(board, piece))
-
-            # If there are no placements, return failure
-            if len(placements) == 0:
-                return SimulationResult.FAILURE, []
-            
-            # Step 2: Order the placements by score, but randomize the order of placements with the same score
-            placements = sorted(placements, key=lambda x: x[0], reverse=True)
-            sorted_placements = []
-            current_score = placements[0][0]
-            current_group = []
-            for placement in placements:
-                if placement[0] == current_score:
-                    current_group.append(placement)
-                else:
-                    sorted_placements.extend(random.sample(current_group, len(current_group)))
-                    current_group = [placement]
-                    current_score = placement[0]
-            sorted_placements.extend(current_group)
-
-            # Print the maximum score
-            #max_score = max(placements, key=lambda x: x[0])[0]
-
-            # Step 3: Try placements in order of best -> least score
-            for score, shape, anchor in sorted_placements:
-                # Reset the board and sequence (undo anything done in past iterations of this loop)
-                board = np.copy(_board)
-                sequence = []
-
-                # Build placement object
-                placement = (shape, anchor)
-                sequence.append(placement)
-
-                # Put the shape onto the board (make the placement)
-                apply_shape(*placement, board, not self.enforce_gravity)
-
-                # Re-evaluate end condition
-                result = SimulationResult.FAILURE if count_false_positives(board) > self.allowable_false_positives else SimulationResult.NOT_DONE if count_false_negatives(board) > self.allowable_false_negatives else SimulationResult.SUCCESS
-
-                if result == SimulationResult.NOT_DONE:
-                    # Step 3a: Recursive call to find the rest of the sequence
-                    result, rest_of_sequence = self.run_simulation(orig_board, board, on_success, [*prev_sequence, *sequence], depth+1)
-                    sequence.extend(rest_of_sequence)
-
-                # On success, trigger on_success function
-                if result == SimulationResult.SUCCESS:
-                    on_success(self.build_animation_from_placements(np.copy(orig_board), [*prev_sequence, *sequence]))
-                    result = SimulationResult.FAILURE
-        return result, sequence
+        candidates = np.flatnonzero(num_false_positives <= self.allowable_false_positives)
+        for i in candidates:
+            if fills_false_negatives[i]:
+                island_counts = self.island_counts(islands, list(zip(batch.cell_xs[i].tolist(), batch.cell_ys[i].tolist())))
+            else:
+                island_counts = (islands.num_stragglers, islands.num_islands)
+
+            # Add this position and its score to output array iff its placement would not cause failure
+            if not self.would_fail(int(num_false_positives[i]), *island_counts):
+                shape = (int(batch.piece_ids[i]), int(batch.rotation_ids[i]))
+                anchor = (int(batch.anchors[i, 0]), int(batch.anchors[i, 1]))
+                placements.append((scores[i].item(), shape, anchor))
+        if self.stats is not None:
+            self.stats.placements_generated += len(batch.piece_ids)
+            self.stats.placements_kept += len(placements)
+            self.stats.prune("false_positives", len(batch.piece_ids) - len(candidates))
+            self.stats.prune("would_fail", len(candidates) - len(placements))
+        return placements
+    
+    # Returns the straggler and island counts of the islands after the given cells are filled (a separate method so it can be timed)
+    def island_counts(self, islands: IslandTracker, cells):
+        return islands.counts_after(cells)
 
+    # Returns True iff a board with the given counts can no longer meet the allowable false positives and negatives
+    def would_fail(self, num_false_positives, num_stragglers, num_needed_false_positives):
+        return num_false_positives > self.allowable_false_positives or (num_false_positives + num_needed_false_positives > self.allowable_false_positives and num_stragglers > self.allowable_false_negatives)
 
-    def build_animation_from_placements(self, _board, placements):
-        frames = []
-        board = np.copy(_board)
+    # Returns True iff the board can no longer meet the allowable false negatives, by lower bounds on the false negatives it must keep:
+    #   Under gravity, pieces fall straight down from their spawn rows, so the false negatives below a blocked cell are never filled.
+    #   Any other island of false negatives keeps at least (size % 4) of them unfilled, unless a piece covers both its cells and a false positive
+    #     (cells of different islands are never adjacent, so a piece only reaches outside an island through a false positive).
+    #   A piece with k false positives touches at most 4 - k islands, so each false positive left in the budget can help at most 3 islands,
+    #     and the islands with the smallest remainders are assumed to be the ones helped.
+    # Coloring arguments add nothing here: a T covers 3 cells of one checkerboard color, so it can even out any island.
+    def cannot_succeed(self, board, num_false_positives, islands: IslandTracker):
+        num_unreachable = 0
+        sizes = islands.sizes
+        if self.enforce_gravity:
+            unreachable = unreachable_false_negatives(board)
+            num_unreachable = int(np.count_nonzero(unreachable))
+            if num_unreachable > self.allowable_false_negatives:
+                return True
+            if num_unreachable > 0:
+                _, sizes = label_islands((board.values == CellValue.FALSE_NEGATIVE.value) & ~unreachable)
+                sizes = sizes.tolist()
+
+        remainders = sorted(size % 4 for size in sizes if size % 4 != 0)
+        num_helped = 3 * max(0, self.allowable_false_positives - num_false_positives)
+        return num_unreachable + sum(remainders[:max(0, len(remainders) - num_helped)]) > self.allowable_false_negatives
+
+    # Orders placements by score, but randomizes the order of placements with the same score
+    def order_placements(self, placements):
+        placements = sorted(placements, key=lambda x: x[0], reverse=True)
+        sorted_placements = []
+        current_score = placements[0][0]
+        current_group = []
+        for placement in placements:
+            if placement[0] == current_score:
+                current_group.append(placement)
+            else:
+                sorted_placements.extend(random.sample(current_group, len(current_group)))
+                current_group = [placement]
+                current_score = placement[0]
+        sorted_placements.extend(current_group)
+        return sorted_placements
+
+    # Searches for placement sequences that turn the board into the target image, calling on_success with the animation of each one found.
+    # See SearchEngine for how the search is done (and for running it in steps, with checkpoints).
+    def run_simulation(self, orig_board: Board, _board: Board, on_success: Callable[[tuple], None]):
+        result = SearchEngine(self, orig_board, lambda placements: on_success(self.build_animation_from_placements(orig_board.copy(), placements)), _board).run()
+        if self.transposition_table is not None:
+            self.transposition_table.log_stats()
+        return result, []
+
+    # Yields the board at each frame of the animation of the placements.
+    # The same board is yielded every time, so each frame must be read before the next one is requested.
+    def animation_boards(self, _board, placements):
+        board = _board.copy()
         for placement in placements:
             # Set the piece
             shape, anchor = set_piece(board, placement[0])   
-            # curr_cell_val = board[anchor[0], anchor[1], :]
-            # board[placement[1][0], placement[1][1]] = (curr_cell_val[0], curr_cell_val[1], "P")
-            frames.append(board[:, :, 2].T.tolist())
+            yield board
 
-            # Find the action sequence
-            sequence = generate_action_sequence(placement, board, shape, anchor)
+            # Find the action sequence. Under gravity every placement is a straight drop, so it is generated directly.
+            # Otherwise, it is the shortest one that actually reaches the placement, if there is one.
+            sequence = None if self.enforce_gravity else Reachability(board).path(*placement)
+            if sequence is None:
+                sequence = generate_action_sequence(placement, board, shape, anchor)
 
-            # Take the actions in the sequence
+            # Take the actions in the sequence, and lock the piece where it ends up (unless it already locked by landing)
             for action in sequence:
                 shape, anchor = take_action(shape, anchor, board, action)
-                frames.append(board[:, :, 2].T.tolist())
-            apply_shape(shape, anchor, board, True)
-        return frames
-    
-    # def run_simulation(self, board):
-    #     result, placements = self.find_placements(board)
-    #     if result == SimulationResult.SUCCESS:
-    #         return SimulationResult.SUCCESS, self.build_animation_from_placements(board, placements)
-    #     else:
-    #         return SimulationResult.FAILURE, []
+                yield board
+            if board.ghosts.any():
+                clear_ghosts(board)
+                apply_shape(shape, anchor, board, True)
 
+    # Returns the animation of the placements in the agent's animation format:
+    #   a list of frames for "frames", or else a generator of chunks (which builds each chunk as it is requested)
+    def build_animation_from_placements(self, _board, placements):
+        boards = self.animation_boards(_board, placements)
+        if self.animation_format == "frames":
+            return [get_frame(board) for board in boards]
+        return encode_animation(boards, self.animation_format == "packed", self.animation_chunk_size)
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 from enum import Enum
+from typing import NamedTuple
 from utils import log
 
 # This enum is designed so that, when a block is placed, each of its cell values can be updated by incrementing by 1.
@@ -31,32 +32,102 @@ pieces = {
 }
 piece_names = ['T', 'J', 'L', 'Z', 'S', 'I', 'O']
 
-# Returns a 4x4 grid representing the piece. 
+# Returns a 4x4 grid representing the cells of a list of coordinates.
 # If a piece has equivalent orientations, those orientations will produce the same grid.
-def get_shape_grid(shape):
+def _shape_grid(cells):
     # Determine anchor location
-    sum_x = max([coord[0] for coord in shape]) + min([coord[0] for coord in shape])
-    sum_y = max([coord[1] for coord in shape]) + min([coord[1] for coord in shape])
+    sum_x = max([coord[0] for coord in cells]) + min([coord[0] for coord in cells])
+    sum_y = max([coord[1] for coord in cells]) + min([coord[1] for coord in cells])
     anchor = (1 if sum_x>=0 else 2, 1 if sum_y>=0 else 2)
 
     # Populate grid
     grid = np.zeros(shape=(4, 4))
-    for coord in shape:
+    for coord in cells:
         grid[int(anchor[1] + coord[1])%4, int(anchor[0] + coord[0])%4] = 1
     return grid
 
-def rotated(shape, cclk=False):
+def _rotated_cells(cells, cclk=False):
     if not cclk:
-        return [(-j, i) for i, j in shape]
+        return [(-j, i) for i, j in cells]
     else:
-        return [(j, -i) for i, j in shape]
+        return [(j, -i) for i, j in cells]
+
+
+# Static description of one unique orientation of a piece
+class Orientation(NamedTuple):
+    cells: tuple            # (dx, dy) offset of each cell from the anchor
+    extents: tuple          # (min dx, max dx, min dy, max dy) of the cells
+    spawn_height: int       # The lowest anchor height at which every cell is on the board
+    rotated_left: int       # rotation_id reached by TetrisAction.ROTATE_LEFT
+    rotated_right: int      # rotation_id reached by TetrisAction.ROTATE_RIGHT
+
+# Builds the unique orientations of a piece, in the order they are reached by repeatedly rotating its base shape
+def _build_orientations(base_cells):
+    cells_list = []
+    cells = list(base_cells)
+    while not any(np.array_equal(_shape_grid(cells), _shape_grid(seen)) for seen in cells_list) and len(cells_list) < 4:
+        cells_list.append(cells)
+        cells = _rotated_cells(cells)
+
+    def rotation_id(cells):
+        return next(i for i, seen in enumerate(cells_list) if np.array_equal(_shape_grid(cells), _shape_grid(seen)))
+
+    return tuple(Orientation(
+        cells=tuple(cells),
+        extents=(min(i for i, _ in cells), max(i for i, _ in cells), min(j for _, j in cells), max(j for _, j in cells)),
+        spawn_height=abs(min(j for _, j in cells)),
+        rotated_left=rotation_id(_rotated_cells(cells, cclk=False)),
+        rotated_right=rotation_id(_rotated_cells(cells, cclk=True)),
+    ) for cells in cells_list)
+
+# orientation_table[piece_id][rotation_id] describes that orientation of the piece named piece_names[piece_id].
+# Throughout the engine, a shape is a (piece_id, rotation_id) tuple, and rotation_id 0 is the spawn orientation.
+orientation_table = tuple(_build_orientations(pieces[name]) for name in piece_names)
+piece_ids = list(range(len(piece_names)))
+
+def get_orientation(shape) -> Orientation:
+    return orientation_table[shape[0]][shape[1]]
+
+def rotated(shape, cclk=False):
+    orientation = get_orientation(shape)
+    return (shape[0], orientation.rotated_right if cclk else orientation.rotated_left)
+
+# Returns the name of the given piece
+def get_piece_name(shape):
+    return piece_names[shape[0]]
+
+
+# A board is stored as three contiguous planes indexed by [x, y], rather than as an array of (value, is_ghost, piece_name) tuples.
+# This keeps copies and feature scans as plain vectorized numpy operations.
+class Board:
+    NO_PIECE = -1
+
+    def __init__(self, values: np.ndarray, ghosts: np.ndarray = None, piece_ids: np.ndarray = None):
+        self.values = values                                                                            # CellValue of each cell
+        self.ghosts = ghosts if ghosts is not None else np.zeros(values.shape, dtype=bool)              # True iff the cell is part of a falling (ghost) piece
+        self.piece_ids = piece_ids if piece_ids is not None else np.full(values.shape, Board.NO_PIECE, dtype=np.int8)  # Index into piece_names, or NO_PIECE
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def copy(self):
+        return Board(self.values.copy(), self.ghosts.copy(), self.piece_ids.copy())
+
+    # Returns a boolean mask of the cells that block a piece (filled and not ghost)
+    def blocked(self):
+        return filled_mask(self.values) & ~self.ghosts
+
+
+def filled_mask(values: np.ndarray):
+    return (values == CellValue.FILLED.value) | (values == CellValue.FALSE_POSITIVE.value)
 
 
 # Returns False iff it is possible for the shape to occupy that anchor location
-def is_occupied(shape, anchor, board):
-    for i, j in shape:
+def is_occupied(shape, anchor, board: Board):
+    for i, j in get_orientation(shape).cells:
         x, y = anchor[0] + i, anchor[1] + j
-        if x < 0 or y < 0 or x >= board.shape[0] or y >= board.shape[1] or (is_filled(board[x, y][0]) and not board[x,y][1]):
+        if x < 0 or y < 0 or x >= board.shape[0] or y >= board.shape[1] or (is_filled(board.values[x, y]) and not board.ghosts[x, y]):
             return True
     return False
 
@@ -65,34 +136,6 @@ def is_occupied(shape, anchor, board):
 def has_dropped(shape, anchor, board):
     return is_occupied(shape, (anchor[0], anchor[1] + 1), board)
 
-# Returns True iff the shapes (piece AND orientation) are the same
-def shape_match(shape1, shape2):
-    return np.array_equal(get_shape_grid(shape1), get_shape_grid(shape2))
-
-# Returns True iff the pieces represented by the shapes are the same, regardless of orientation.
-def piece_match(shape1, shape2):
-    covered_all_orientations = False
-    new_shape = np.copy(shape1)
-    while not covered_all_orientations:
-        new_shape = rotated(new_shape)
-        if shape_match(new_shape, shape1):
-            covered_all_orientations = True
-        if shape_match(new_shape, shape2):
-            return True
-    return False
-
-# Returns the name of the given piece
-def get_piece_name(piece):
-    for name in piece_names:
-        if piece_match(piece, pieces[name]):
-            return name
-    return None
-
-# Returns the index of this piece in the shapes list
-def get_piece_index(piece):
-    return piece_names.index(get_piece_name(piece))
-
-
 ##                            ##
 ## FUNCTIONS FOR GAME ACTIONS ##
 ##                            ##
@@ -136,153 +179,174 @@ class TetrisAction(Enum):
     ROTATE_RIGHT=rotate_right
     IDLE=idle
 
-def take_action(shape, anchor, board: np.ndarray, action: TetrisAction):
+def take_action(shape, anchor, board: Board, action: TetrisAction):
     new_vals = action(shape, anchor, board)
     clear_ghosts(board)
     apply_shape(*new_vals, board)
     return new_vals
 
 
-def clear_ghosts(board: np.ndarray):
-    is_ghost = board[:, :, 1]  # Extract the is_ghost values
-
+def clear_ghosts(board: Board):
     # Subtract 1 from the cell value of every ghost block and set it to non-ghost
-    for index, value in np.ndenumerate(is_ghost):
-        if value:
-            board[index] = (board[index][0]-1, False, None)
+    ghosts = board.ghosts
+    board.values[ghosts] -= 1
+    board.piece_ids[ghosts] = Board.NO_PIECE
+    ghosts[:] = False
 
 
-def apply_shape(shape, anchor, board: np.ndarray, force_not_ghost=False):
-    for i, j in shape:
+def apply_shape(shape, anchor, board: Board, force_not_ghost=False):
+    # Ghost cells never block, so whether the shape has dropped is the same before and after it is applied
+    is_ghost = not force_not_ghost and not has_dropped(shape, anchor, board)
+    piece_index = shape[0]
+    for i, j in get_orientation(shape).cells:
         x, y = i + anchor[0], j + anchor[1]
         if x < board.shape[0] and x >= 0 and y < board.shape[1] and y >= 0:
-            # Determine new values
-            curr_value, curr_is_ghost, curr_piece_index = board[x, y]
-
-            # If this cell is already filled, then there is no need to update its value
-            new_val = curr_value + 1
-            new_is_ghost = not has_dropped(shape, anchor, board) and not force_not_ghost
-            new_piece_name = get_piece_name(shape)
-
-            # Set cell
-            board[x,y] = (new_val, new_is_ghost, new_piece_name)
-
-
-def count_false_negatives(board: np.ndarray):
-    return np.count_nonzero(board[:, :, 0] == CellValue.FALSE_NEGATIVE.value)
-
-def count_false_positives(board: np.ndarray):
-    return np.count_nonzero(board[:, :, 0] == CellValue.FALSE_POSITIVE.value)
-
-def count_buried_false_negatives(board: np.ndarray):
-    # For every column, work up from the bottom to determine how many false negatives are buried
-    output = 0
-    for x in range(board.shape[0]):
-        count = 0
-        for y in reversed(range(board.shape[1])):
-            if board[x,y][0] == CellValue.FALSE_NEGATIVE.value:
-                count+=1
-            if is_filled(board[x,y][0]):
-                output += count
-                count = 0
-    return output
-
-def count_wells(board: np.ndarray):
-    # Determine the number of 3-high, 1-wide wells on the board
+            board.values[x, y] += 1
+            board.ghosts[x, y] = is_ghost
+            board.piece_ids[x, y] = piece_index
+
+
+# The column_* functions compute a feature separately for each column of a values array shaped (..., width, height).
+# Leading dimensions are treated as a batch of independent boards, and columns outside of the array count as empty.
+# Every count_* feature is the sum of its column_* counterpart over the whole board.
+def column_false_negatives(values: np.ndarray):
+    return np.count_nonzero(values == CellValue.FALSE_NEGATIVE.value, axis=-1)
+
+def column_false_positives(values: np.ndarray):
+    return np.count_nonzero(values == CellValue.FALSE_POSITIVE.value, axis=-1)
+
+def column_buried_false_negatives(values: np.ndarray):
+    # A false negative is buried iff there is a filled cell above it in its column (y increases downwards)
+    filled_above = np.logical_or.accumulate(filled_mask(values), axis=-1)
+    return np.count_nonzero(filled_above & (values == CellValue.FALSE_NEGATIVE.value), axis=-1)
+
+# Returns the number of 3-high runs of isolated cells in each column, where a run is a vertical span of cells in `mask`
+#   and a cell is isolated iff neither of its horizontal neighbors is in `mask`.
+# Non-isolated cells of `mask` do not end a run, they just do not add to its height.
+def _column_isolated_runs(mask: np.ndarray):
+    isolated = mask.copy()
+    isolated[..., 1:, :] &= ~mask[..., :-1, :]
+    isolated[..., :-1, :] &= ~mask[..., 1:, :]
+
+    # Running count of isolated cells, and its value at the most recent cell outside of the mask (where the current run started)
+    breaks = ~mask
+    num_isolated = np.cumsum(isolated, axis=-1, dtype=np.int32)
+    run_start = np.maximum.accumulate(num_isolated * breaks, axis=-1)
+
+    # Every cell outside of the mask ends the run above it, and the bottom of the column ends the last run
+    ended_runs = num_isolated[..., 1:] - run_start[..., :-1]
+    ended_runs //= 3
+    ended_runs *= breaks[..., 1:]
+    return np.sum(ended_runs, axis=-1) + (num_isolated[..., -1] - run_start[..., -1]) // 3
+
+def column_wells(values: np.ndarray):
+    # Determine the number of 3-high, 1-wide wells in each column
     # This is a feature designed to limit excessive I-piece placements
-    output = 0
-    for x in range(board.shape[0]):
-        well_height = 0
-        for y in reversed(range(board.shape[1])):
-            if board[x,y][0] == CellValue.FALSE_NEGATIVE.value:
-                # Check the cell to the left and right. If neither is false positive, this cell is part of a well.
-                if (x-1 < 0 or board[x-1,y][0] != CellValue.FALSE_NEGATIVE.value) and (x+1 >= board.shape[0] or board[x+1,y][0] != CellValue.FALSE_NEGATIVE.value):
-                    well_height += 1
-            else:
-                # If a non-false negative was found, then the well must have ended
-                output += well_height // 3
-                well_height = 0
-        output += well_height // 3
-    return output
-
-def count_towers(board: np.ndarray):
-    # Determine the number of 3-high, 1-wide towers on the board
+    return _column_isolated_runs(values == CellValue.FALSE_NEGATIVE.value)
+
+def column_towers(values: np.ndarray):
+    # Determine the number of 3-high, 1-wide towers in each column
     # This is a feature designed to limit excessive I-piece placements
-    output = 0
-    for x in range(board.shape[0]):
-        tower_height = 0
-        for y in reversed(range(board.shape[1])):
-            if is_filled(board[x,y][0]):
-                # Check the cell to the left and right. If neither are filled, this cell is part of a tower.
-                if (x-1 < 0 or not is_filled(board[x-1,y][0])) and (x+1 >= board.shape[0] or not is_filled(board[x+1,y][0])):
-                    tower_height += 1
-            else:
-            # If a non-filled cell was found, then the well must have ended
-                output += tower_height // 3
-                tower_height = 0
-        output += tower_height // 3
-    return output
-
-def count_ghosts(board: np.ndarray):
-    return np.count_nonzero(board[:, :, 1])
+    return _column_isolated_runs(filled_mask(values))
+
+def count_false_negatives(board: Board):
+    return int(np.sum(column_false_negatives(board.values)))
+
+def count_false_positives(board: Board):
+    return int(np.sum(column_false_positives(board.values)))
+
+def count_buried_false_negatives(board: Board):
+    return int(np.sum(column_buried_false_negatives(board.values)))
+
+def count_wells(board: Board):
+    return int(np.sum(column_wells(board.values)))
+
+def count_towers(board: Board):
+    return int(np.sum(column_towers(board.values)))
+
+# Maps each whole-board feature to its per-column form
+column_features = {
+    count_false_negatives: column_false_negatives,
+    count_false_positives: column_false_positives,
+    count_buried_false_negatives: column_buried_false_negatives,
+    count_wells: column_wells,
+    count_towers: column_towers,
+}
+
+def count_ghosts(board: Board):
+    return np.count_nonzero(board.ghosts)
+
+# Labels the 4-connected islands of cells in a boolean mask, without recursion.
+# Uses a vectorized union-find: every cell starts as its own root, the larger root of each pair of adjacent roots is hooked onto the smaller one,
+#   and pointer jumping flattens the trees, until every pair of adjacent cells shares a root.
+# Returns (labels, sizes), where labels has the shape of the mask and holds the island index of each cell (-1 outside the mask),
+#   and sizes[i] is the number of cells in island i.
+def label_islands(mask: np.ndarray):
+    index = np.arange(mask.size).reshape(mask.shape)
+    horizontal = mask[:-1] & mask[1:]
+    vertical = mask[:, :-1] & mask[:, 1:]
+    u = np.concatenate([index[:-1][horizontal], index[:, :-1][vertical]])
+    v = np.concatenate([index[1:][horizontal], index[:, 1:][vertical]])
+
+    parent = np.arange(mask.size)
+    while len(u) > 0:
+        root_u, root_v = parent[u], parent[v]
+        unmerged = root_u != root_v
+        u, v, root_u, root_v = u[unmerged], v[unmerged], root_u[unmerged], root_v[unmerged]
+        np.minimum.at(parent, np.maximum(root_u, root_v), np.minimum(root_u, root_v))
+
+        # Pointer jumping (every cell ends up pointing directly at its root)
+        grandparent = parent[parent]
+        while not np.array_equal(grandparent, parent):
+            parent = grandparent
+            grandparent = parent[parent]
+
+    labels = np.full(mask.shape, -1, dtype=np.int32)
+    roots, labels[mask], sizes = np.unique(parent[index[mask]], return_inverse=True, return_counts=True)
+    return labels, sizes
 
 # A "straggler" is a false negative that cannot be filled without creating at least one false positive.
-# This function uses DFS to determine the mod4 size of each island of false negatives, 
-#   then returns a tuple containing the number of stragglers and the total number of islands.
+# Each island of false negatives has (island size % 4) stragglers.
+# This function returns a tuple containing the number of stragglers and the total number of islands.
 # The number of islands can be used as the lower bound for the number of false positives required to fill all stragglers (one per island).
 # Note that it is not correct to say that the stragglers of an island can be filled by a minimum of 4-(island size % 4) false positives, 
 #   because it is possible that placing a single block could fill the stragglers of multiple islands (max 3).
-def count_stragglers(board: np.ndarray):
-    num_stragglers = 0
-    num_islands = 0
-    visited = np.full((board.shape[0], board.shape[1]), False)
-
-    def dfs(x, y):
-        currentSize = 0
+def count_stragglers(board: Board):
+    _, sizes = label_islands(board.values == CellValue.FALSE_NEGATIVE.value)
+    return (int(np.sum(sizes % 4)), len(sizes))
 
-        # Bounds check
-        if (0 <= x and x < board.shape[0]) and (0 <= y and y < board.shape[1]) and not visited[x][y]:
-            visited[x][y] = True
 
-            # Value check
-            if board[x][y][0] == CellValue.FALSE_NEGATIVE.value:
-                currentSize += 1
+# Pieces spawn with their highest cell in row 0 and only ever move straight down, so every cell of a piece starts at or above this row
+MAX_START_ROW = max(orientation.spawn_height + orientation.extents[3] for orientations in orientation_table for orientation in orientations)
 
-                # Recursive calls (one for each neighbor)
-                for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                    currentSize += dfs(x + dx, y + dy)
-        return currentSize
-
-    for x in range(board.shape[0]):
-        for y in range(board.shape[1]):
-            if not visited[x][y] and board[x][y][0] == CellValue.FALSE_NEGATIVE.value:
-                num_stragglers += dfs(x, y) % 4
-                num_islands += 1
-
-    return (num_stragglers, num_islands)
+# Returns a mask of the false negatives that no piece can reach anymore, since a blocked cell lies between them and every row a piece's cell can start in
+def unreachable_false_negatives(board: Board):
+    blocked = board.blocked()
+    blocked[:, :MAX_START_ROW] = False
+    return np.logical_or.accumulate(blocked, axis=1) & (board.values == CellValue.FALSE_NEGATIVE.value)
 
 
 def board_from_grid(grid: np.ndarray):
-    # Populate board with tuples of (CellValue, is_ghost, piece_name)
-    board = np.empty((*grid.T.shape, 3), dtype='object')
-    for index, value in np.ndenumerate(grid.T):
-        board[index] = (CellValue.FALSE_NEGATIVE.value if value else CellValue.EMPTY.value, False, None)  
-    return board
+    # Selected cells start as false negatives, everything else starts empty
+    values = np.where(np.asarray(grid, dtype=bool).T, CellValue.FALSE_NEGATIVE.value, CellValue.EMPTY.value).astype(np.uint8)
+    return Board(values)
 
-def get_random_piece(board: np.ndarray):
-    # Choose piece
-    piece = random.sample(pieces)
-    return set_piece(board, piece)
+# Returns the frame for the current board state: a height x width list of the piece name in each cell (None if empty)
+_frame_names = np.array([*piece_names, None], dtype='object')
+def get_frame(board: Board):
+    return _frame_names[board.piece_ids.T].tolist()
 
+def get_random_piece(board: Board):
+    # Choose piece
+    piece_id = random.choice(piece_ids)
+    return set_piece(board, (piece_id, 0))
 
-def set_piece(board: np.ndarray, shape):
-    piece = pieces[get_piece_name(shape)]
 
-    # Determine the height of the anchor to get the whole shape on the screen
-    height = abs(min(y for _, y in piece))
+def set_piece(board: Board, shape):
+    piece = (shape[0], 0)
 
-    # Place shape at the top of the board in the center
-    anchor = (board.shape[0] // 2, height)
+    # Place shape at the top of the board in the center, high enough to get the whole shape on the screen
+    anchor = (board.shape[0] // 2, get_orientation(piece).spawn_height)
 
     # Apply the piece
     apply_shape(piece, anchor, board)
@@ -291,8 +355,8 @@ def set_piece(board: np.ndarray, shape):
     return (piece, anchor)
 
 
-def print_board(board: np.ndarray):
+def print_board(board: Board):
     s = '\n+' + '-' * board.shape[0] + '+\n'
-    s += '\n'.join(['|' + ''.join([str(j[0]) if not j[1] else 'G' for j in i]) + '|' for i in np.transpose(board, axes=(1, 0, 2))])
+    s += '\n'.join(['|' + ''.join([str(value) if not is_ghost else 'G' for value, is_ghost in zip(values, ghosts)]) + '|' for values, ghosts in zip(board.values.T, board.ghosts.T)])
     s += '\n+' + '-' * board.shape[0] + '+'
     return s    
\ No newline at end of file
@@ -0,0 +1,417 @@
+import numpy as np
+from collections import deque
+from typing import NamedTuple
+from tetris_env import Board, CellValue, TetrisAction, apply_shape, column_features, get_orientation, label_islands, orientation_table
+
+# Keeps the per-column value of each feature for a board, so that the features of the board after a placement
+#   can be found by recomputing only the columns that the placement can affect.
+# A placed cell can only change features in its own column and in the columns directly beside it (wells and towers look at horizontal neighbors),
+#   and recomputing those columns needs one more column of context on each side.
+class FeatureEvaluator:
+    # Candidate placements are scored in windows of WINDOW_WIDTH columns, starting 2 columns left of the placement's leftmost cell.
+    # The inner columns (all but the first and last) cover every column a piece (at most 4 wide) can affect.
+    WINDOW_WIDTH = 8
+
+    def __init__(self, features: list, board: Board):
+        self.column_functions = [column_features[feature] for feature in features]
+        self.reset(board)
+
+    # Recomputes every column of the board from scratch
+    def reset(self, board: Board):
+        self.columns = np.array([function(board.values) for function in self.column_functions], dtype=np.int64).reshape(len(self.column_functions), board.shape[0])
+        self.totals = self.columns.sum(axis=1)
+
+    # Returns (lo, hi), the range of columns whose features can change when the given shape is placed at the given anchor
+    def affected_columns(self, board: Board, shape, anchor):
+        min_dx, max_dx, _, _ = get_orientation(shape).extents
+        return max(anchor[0] + min_dx - 1, 0), min(anchor[0] + max_dx + 2, board.shape[0])
+
+    # Returns the per-column features of columns [lo, hi) for the given board values
+    def _window_columns(self, values: np.ndarray, lo, hi):
+        window_lo, window_hi = max(lo - 1, 0), min(hi + 1, values.shape[0])
+        window = values[window_lo:window_hi]
+        return np.array([function(window)[lo - window_lo:hi - window_lo] for function in self.column_functions], dtype=np.int64).reshape(len(self.column_functions), hi - lo)
+
+    # Returns the feature values of the board as it would be after each of a batch of placements, without modifying the board.
+    # cell_xs and cell_ys are (num_placements, cells per placement) arrays of the on-board cells filled by each placement.
+    # The output has shape (num_features, num_placements).
+    def features_after(self, board: Board, cell_xs: np.ndarray, cell_ys: np.ndarray):
+        num_features, num_placements = len(self.column_functions), len(cell_xs)
+        if num_placements == 0:
+            return np.zeros((num_features, 0), dtype=np.int64)
+
+        # Pad the board with empty columns, which have no features and do not affect their neighbors, so every window fits
+        width = board.shape[0]
+        padded = np.zeros((width + self.WINDOW_WIDTH, board.shape[1]), dtype=board.values.dtype)
+        padded[2:width + 2] = board.values
+
+        # Gather every window (padded column `start + i` is board column `start + i - 2`) and apply its placement
+        starts = cell_xs.min(axis=1)
+        windows = padded[starts[:, None] + np.arange(self.WINDOW_WIDTH)]
+        windows[np.arange(num_placements)[:, None], cell_xs - starts[:, None] + 2, cell_ys] += 1
+        new_columns = np.array([function(windows)[:, 1:-1].sum(axis=1) for function in self.column_functions], dtype=np.int64).reshape(num_features, num_placements)
+
+        # Sum the current features of the same inner columns using prefix sums over the padded columns
+        prefix = np.zeros((num_features, width + self.WINDOW_WIDTH + 1), dtype=np.int64)
+        prefix[:, 3:width + 3] = np.cumsum(self.columns, axis=1)
+        prefix[:, width + 3:] = prefix[:, width + 2:width + 3]
+        old_columns = prefix[:, starts + self.WINDOW_WIDTH - 1] - prefix[:, starts + 1]
+        return self.totals[:, None] + new_columns - old_columns
+
+    # Brings the stored columns up to date after the shape has been applied to (or removed from) the board at the anchor
+    def update(self, board: Board, shape, anchor):
+        lo, hi = self.affected_columns(board, shape, anchor)
+        new_columns = self._window_columns(board.values, lo, hi)
+        self.totals += new_columns.sum(axis=1) - self.columns[:, lo:hi].sum(axis=1)
+        self.columns[:, lo:hi] = new_columns
+
+
+# Returns the on-board cells covered by the shape at the anchor
+def placed_cells(board: Board, shape, anchor):
+    cells = []
+    for i, j in get_orientation(shape).cells:
+        x, y = anchor[0] + i, anchor[1] + j
+        if 0 <= x < board.shape[0] and 0 <= y < board.shape[1]:
+            cells.append((x, y))
+    return cells
+
+
+# Keeps the islands of false negatives of a board labelled, so that the straggler counts after a placement
+#   can be found by relabelling only the islands that the placement fills cells of.
+# Placements never create false negatives, so every other island is unaffected.
+class IslandTracker:
+    def __init__(self, board: Board):
+        self.reset(board)
+
+    # Relabels every island of the board from scratch
+    def reset(self, board: Board):
+        self.labels, sizes = label_islands(board.values == CellValue.FALSE_NEGATIVE.value)
+        self.sizes = sizes.tolist()
+        self.num_stragglers = int(np.sum(sizes % 4))
+        self.num_islands = len(sizes)
+
+        # Bounding box (x0, y0, x1, y1) of each island, so relabelling an island only looks at its own region.
+        # When an island is split, its pieces keep its bounding box, which still contains them.
+        xs, ys = np.nonzero(self.labels >= 0)
+        labels = self.labels[xs, ys]
+        bounds = np.zeros((4, len(sizes)), dtype=np.int64)
+        bounds[0], bounds[1] = board.shape
+        np.minimum.at(bounds[0], labels, xs)
+        np.minimum.at(bounds[1], labels, ys)
+        np.maximum.at(bounds[2], labels, xs + 1)
+        np.maximum.at(bounds[3], labels, ys + 1)
+        self.bounds = [tuple(bound) for bound in bounds.T.tolist()]
+
+    # Returns True iff the island stays in one piece once the given cells (all part of it) are filled.
+    # Any path through the filled cells can be rerouted around them if the island cells next to them are still connected
+    #   within one cell of the filled cells, so only that small region is searched.
+    def _stays_connected(self, label, filled):
+        filled_set = set(filled)
+        x0, x1 = min(x for x, _ in filled) - 1, max(x for x, _ in filled) + 1
+        y0, y1 = min(y for _, y in filled) - 1, max(y for _, y in filled) + 1
+        width, height = self.labels.shape
+
+        def in_region(x, y):
+            return x0 <= x <= x1 and y0 <= y <= y1 and 0 <= x < width and 0 <= y < height and (x, y) not in filled_set and self.labels[x, y] == label
+
+        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        neighbors = {(x + dx, y + dy) for x, y in filled for dx, dy in directions if in_region(x + dx, y + dy)}
+        if len(neighbors) == 0:
+            return False
+        start = next(iter(neighbors))
+        visited, stack = {start}, [start]
+        while stack:
+            x, y = stack.pop()
+            for dx, dy in directions:
+                cell = (x + dx, y + dy)
+                if cell not in visited and in_region(*cell):
+                    visited.add(cell)
+                    stack.append(cell)
+        return neighbors <= visited
+
+    # Returns the (labels, sizes) of the pieces left of each island touched by the given cells once those cells are filled,
+    #   where the labels cover the island's bounding box.
+    # If the island stays in one piece, its labels are not recomputed and are None instead.
+    def _split_islands(self, cells):
+        splits = {}
+        for label in {int(self.labels[x, y]) for x, y in cells if self.labels[x, y] >= 0}:
+            filled = [(x, y) for x, y in cells if self.labels[x, y] == label]
+            if self._stays_connected(label, filled):
+                splits[label] = (None, np.array([self.sizes[label] - len(filled)]))
+                continue
+            x0, y0, x1, y1 = self.bounds[label]
+            remaining = self.labels[x0:x1, y0:y1] == label
+            for x, y in filled:
+                remaining[x - x0, y - y0] = False
+            splits[label] = label_islands(remaining)
+        return splits
+
+    # Returns (num_stragglers, num_islands) of the board as it would be after filling the given cells, without modifying anything
+    def counts_after(self, cells):
+        num_stragglers, num_islands = self.num_stragglers, self.num_islands
+        for label, (_, sizes) in self._split_islands(cells).items():
+            num_stragglers += int(np.sum(sizes % 4)) - self.sizes[label] % 4
+            num_islands += len(sizes) - 1
+        return num_stragglers, num_islands
+
+    # Brings the labels up to date after the given cells have been filled, and returns a record that undo() can revert it with.
+    # The first piece of a split island keeps the island's label, and the other pieces get new labels.
+    def update(self, cells):
+        changes = []
+        counts = (self.num_stragglers, self.num_islands)
+        for label, (split_labels, split_sizes) in self._split_islands(cells).items():
+            x0, y0, x1, y1 = self.bounds[label]
+            filled = [(x, y) for x, y in cells if self.labels[x, y] == label]
+            changes.append((label, self.sizes[label], len(self.sizes), filled))
+            for x, y in filled:
+                self.labels[x, y] = -1
+
+            self.num_stragglers += int(np.sum(split_sizes % 4)) - self.sizes[label] % 4
+            self.num_islands += len(split_sizes) - 1
+            if split_labels is None or len(split_sizes) == 0:
+                self.sizes[label] = int(np.sum(split_sizes))
+                continue
+
+            new_labels = np.array([label, *range(len(self.sizes), len(self.sizes) + len(split_sizes) - 1)], dtype=np.int32)
+            in_split = split_labels >= 0
+            self.labels[x0:x1, y0:y1][in_split] = new_labels[split_labels[in_split]]
+            self.sizes[label] = int(split_sizes[0])
+            self.sizes.extend(split_sizes[1:].tolist())
+            self.bounds.extend([self.bounds[label]] * (len(split_sizes) - 1))
+        return changes, counts
+
+    # Reverts an update(), given the record it returned. Updates must be undone in the reverse order they were made.
+    def undo(self, record):
+        changes, (self.num_stragglers, self.num_islands) = record
+        for label, size, first_new_label, filled in reversed(changes):
+            # Every label from first_new_label onwards was split off this island (later updates have already been undone)
+            x0, y0, x1, y1 = self.bounds[label]
+            region = self.labels[x0:x1, y0:y1]
+            region[region >= first_new_label] = label
+            for x, y in filled:
+                self.labels[x, y] = label
+            self.sizes[label] = size
+            del self.sizes[first_new_label:]
+            del self.bounds[first_new_label:]
+
+
+# A single board that the search applies placements to and removes them from in place,
+#   along with the feature columns, islands, error counts and (optionally) hash of that board, all kept in sync with it.
+# Each applied placement returns a small change record, so the search only ever holds one board plus a few cells per level.
+class SearchState:
+    def __init__(self, board: Board, features: list, hasher=None):
+        self.board = board
+        self.evaluator = FeatureEvaluator(features, board)
+        self.islands = IslandTracker(board)
+        self.num_false_positives = int(np.count_nonzero(board.values == CellValue.FALSE_POSITIVE.value))
+        self.num_false_negatives = int(np.count_nonzero(board.values == CellValue.FALSE_NEGATIVE.value))
+        self.hasher = hasher
+        self.hash = hasher.hash_board(board) if hasher is not None else None
+
+    # Applies the shape at the anchor, and returns the change record needed to undo it
+    def apply(self, shape, anchor, force_not_ghost=False):
+        board = self.board
+        cells = placed_cells(board, shape, anchor)
+        old_cells = [(int(board.values[cell]), bool(board.ghosts[cell]), int(board.piece_ids[cell])) for cell in cells]
+        change = (shape, anchor, cells, old_cells, self.hash, self.islands.update(cells))
+
+        if self.hasher is not None:
+            self.hash = self.hasher.hash_after(self.hash, board, cells)
+        for value, _, _ in old_cells:
+            if value == CellValue.EMPTY.value:
+                self.num_false_positives += 1
+            elif value == CellValue.FALSE_NEGATIVE.value:
+                self.num_false_negatives -= 1
+        apply_shape(shape, anchor, board, force_not_ghost)
+        self.evaluator.update(board, shape, anchor)
+        return change
+
+    # Reverts an apply(), given the change record it returned. Changes must be undone in the reverse order they were made.
+    def undo(self, change):
+        shape, anchor, cells, old_cells, self.hash, island_record = change
+        board = self.board
+        for cell, (value, is_ghost, piece_id) in zip(cells, old_cells):
+            if value == CellValue.EMPTY.value:
+                self.num_false_positives -= 1
+            elif value == CellValue.FALSE_NEGATIVE.value:
+                self.num_false_negatives += 1
+            board.values[cell], board.ghosts[cell], board.piece_ids[cell] = value, is_ghost, piece_id
+        self.islands.undo(island_record)
+        self.evaluator.update(board, shape, anchor)
+
+
+# A batch of candidate placements, in the order they were enumerated
+class PlacementBatch(NamedTuple):
+    piece_ids: np.ndarray       # Piece of each placement
+    rotation_ids: np.ndarray    # Orientation of each placement
+    anchors: np.ndarray         # (num_placements, 2) anchor of each placement
+    cell_xs: np.ndarray         # (num_placements, 4) x of each cell filled by the placement
+    cell_ys: np.ndarray         # (num_placements, 4) y of each cell filled by the placement
+
+# (dx, dy) offsets of every orientation as arrays, for vectorized enumeration
+_orientation_offsets = [[(np.array([i for i, _ in orientation.cells]), np.array([j for _, j in orientation.cells])) for orientation in orientations] for orientations in orientation_table]
+
+# Anchors are offset by this much in collision masks, so that the anchor of every orientation with its cells on the board has a non-negative index
+_ANCHOR_OFFSET = 3
+
+# Every orientation of every piece as a (piece_id, rotation_id) shape, so that the reachable states of all of them are found at once,
+#   along with the index of each shape in the list, and the (dx, dy) offsets of its cells
+_all_shapes = [(piece_id, rotation_id) for piece_id, orientations in enumerate(orientation_table) for rotation_id in range(len(orientations))]
+_shape_indices = {shape: index for index, shape in enumerate(_all_shapes)}
+_all_dxs = np.array([[i for i, _ in get_orientation(shape).cells] for shape in _all_shapes])
+_all_dys = np.array([[j for _, j in get_orientation(shape).cells] for shape in _all_shapes])
+
+# The indices of the two shapes that rotate into each shape (the shape itself stands in for any that do not exist)
+def _rotation_sources(shape):
+    piece_id, rotation_id = shape
+    sources = [_shape_indices[(piece_id, source)] for source, orientation in enumerate(orientation_table[piece_id])
+               if source != rotation_id and rotation_id in (orientation.rotated_left, orientation.rotated_right)]
+    return (sources + [_shape_indices[shape]] * 2)[:2]
+_all_rotation_sources = np.array([_rotation_sources(shape) for shape in _all_shapes]).T
+
+# The index of each piece's spawn shape (see set_piece)
+_spawn_indices = np.array([_shape_indices[(piece_id, 0)] for piece_id in range(len(orientation_table))])
+
+# Returns the collision mask of every shape (in the order of _all_shapes), given the mask of free (unblocked) cells of a board:
+#   masks[index, x + _ANCHOR_OFFSET, y + _ANCHOR_OFFSET] is True iff the shape at anchor (x, y) has every cell on the board and free
+def _collision_masks(free: np.ndarray):
+    width, height = free.shape
+    padded = np.pad(free, 2 * _ANCHOR_OFFSET, constant_values=False)
+    xs = np.arange(width + 2 * _ANCHOR_OFFSET)[None, :, None] + _ANCHOR_OFFSET
+    ys = np.arange(height + 2 * _ANCHOR_OFFSET)[None, None, :] + _ANCHOR_OFFSET
+    masks = padded[xs + _all_dxs[:, 0, None, None], ys + _all_dys[:, 0, None, None]]
+    for k in range(1, _all_dxs.shape[1]):
+        masks &= padded[xs + _all_dxs[:, k, None, None], ys + _all_dys[:, k, None, None]]
+    return masks
+
+# The (shape, anchor) states of every piece that can be reached from its spawn state (as placed by set_piece) by the moves of TetrisAction,
+#   which are where the piece can be placed when gravity is not enforced.
+# A piece locks as soon as it rests on a blocked cell (or the floor), so it only moves on from states where it can still drop (see take_action).
+# The collision masks of the shapes are computed once for the board, and the reachable states are found a whole run of moves at a time
+#   (for every shape at once): a piece that can move keeps moving along a row or column until it reaches a state where it cannot,
+#   and rotating keeps the anchor, so the sweeps along each axis and the rotations are repeated until no more states are reached.
+# The actions that reach a state are only searched for when they are asked for (see path), since they are only needed to animate solutions.
+class Reachability:
+    def __init__(self, board: Board, free: np.ndarray = None):
+        self.masks = _collision_masks(~board.blocked() if free is None else free)
+        self.spawn_x = board.shape[0] // 2 + _ANCHOR_OFFSET
+
+        # The states in which the piece is not resting on anything, so it can still be moved
+        self.movable = self.masks & np.pad(self.masks[:, :, 1:], ((0, 0), (0, 0), (0, 1)), constant_values=False)
+
+        # Moving along a row reaches the whole run of movable states around it, so each run is numbered (from 1, with 0 for the other states).
+        # Moving down a column reaches the movable states below it until the first state that is not, so last_stop is the last such row at or above each state.
+        _, width, height = self.masks.shape
+        run_starts = self.movable.copy()
+        run_starts[:, 1:] &= ~self.movable[:, :-1]
+        runs = np.where(self.movable, np.cumsum(run_starts.transpose(0, 2, 1)).reshape(-1, height, width).transpose(0, 2, 1), 0)
+        rows = np.arange(height)[None, None, :]
+        last_stop = np.maximum.accumulate(np.where(self.movable, -1, rows), axis=2)
+
+        # Find the reachable states from which the piece can still move
+        moving = np.zeros_like(self.masks)
+        for index in _spawn_indices:
+            spawn = (index, self.spawn_x, orientation_table[_all_shapes[index][0]][0].spawn_height + _ANCHOR_OFFSET)
+            moving[spawn] = self.movable[spawn]
+        while True:
+            reached = moving | ((moving[_all_rotation_sources[0]] | moving[_all_rotation_sources[1]]) & self.movable)
+            reached_runs = np.zeros(runs.max() + 1, dtype=bool)
+            reached_runs[runs[reached]] = True
+            reached = reached_runs[runs]
+            reached |= self.movable & (np.maximum.accumulate(np.where(reached, rows, -1), axis=2) > last_stop)
+            if np.array_equal(reached, moving):
+                break
+            moving = reached
+
+        # Every state one move away from those is reached too, including the states where the piece locks
+        self.reached = moving | moving[_all_rotation_sources[0]] | moving[_all_rotation_sources[1]]
+        self.reached[:, :-1] |= moving[:, 1:]
+        self.reached[:, 1:] |= moving[:, :-1]
+        self.reached[:, :, 1:] |= moving[:, :, :-1]
+        self.reached &= self.masks
+        for index in _spawn_indices:
+            spawn = (index, self.spawn_x, orientation_table[_all_shapes[index][0]][0].spawn_height + _ANCHOR_OFFSET)
+            self.reached[spawn] = self.masks[spawn]
+
+    # Returns the x and y of each reachable anchor of the shape
+    def anchors(self, shape):
+        xs, ys = np.nonzero(self.reached[_shape_indices[shape]])
+        return xs - _ANCHOR_OFFSET, ys - _ANCHOR_OFFSET
+
+    # Returns the shortest list of TetrisActions that moves the piece from its spawn state to the state, or None if the state is unreachable.
+    # Of the shortest lists, the one found first tries rotations (right before left) before shifts and shifts before drops at each step,
+    #   which is the same list as generate_action_sequence whenever its straight path is not blocked.
+    def path(self, shape, anchor):
+        target = (_shape_indices[shape], anchor[0] + _ANCHOR_OFFSET, anchor[1] + _ANCHOR_OFFSET)
+        _, width, height = self.masks.shape
+        if not (0 <= target[1] < width and 0 <= target[2] < height) or not self.reached[target]:
+            return None
+
+        piece_id = shape[0]
+        start = (_shape_indices[(piece_id, 0)], self.spawn_x, orientation_table[piece_id][0].spawn_height + _ANCHOR_OFFSET)
+        previous = {start: None}
+        frontier = deque([start])
+        while frontier and target not in previous:
+            state = frontier.popleft()
+            index, x, y = state
+            if not self.movable[state]:
+                continue
+            orientation = get_orientation(_all_shapes[index])
+            for action, next_state in ((TetrisAction.ROTATE_RIGHT, (_shape_indices[(piece_id, orientation.rotated_right)], x, y)),
+                                       (TetrisAction.ROTATE_LEFT, (_shape_indices[(piece_id, orientation.rotated_left)], x, y)),
+                                       (TetrisAction.LEFT, (index, x - 1, y)), (TetrisAction.RIGHT, (index, x + 1, y)), (TetrisAction.SOFT_DROP, (index, x, y + 1))):
+                if next_state not in previous and 0 <= next_state[1] < width and 0 <= next_state[2] < height and self.masks[next_state]:
+                    previous[next_state] = (state, action)
+                    frontier.append(next_state)
+        if target not in previous:
+            return None
+
+        actions = []
+        while previous[target] is not None:
+            target, action = previous[target]
+            actions.append(action)
+        return actions[::-1]
+
+# Returns every placement of the given pieces, in the same order as dropping each orientation of each piece down each column in turn.
+# A piece dropped from its spawn height in a column stops at the first blocked cell below any of its cells,
+#   so every landing position is found from a single table of the next blocked row at or below each cell.
+# If gravity is not enforced, the placements are instead every state that the piece can be moved to from its spawn state (see Reachability),
+#   in order of orientation, then column, then height.
+def enumerate_placements(board: Board, piece_order, enforce_gravity=True):
+    width, height = board.shape
+    blocked = board.blocked()
+    rows = np.where(blocked, np.arange(height), height)
+    next_blocked = np.minimum.accumulate(rows[:, ::-1], axis=1)[:, ::-1]
+
+    # Each list starts with an empty entry so that concatenation works when there are no placements
+    piece_id_list, rotation_id_list = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    x_list, y_list = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    cell_x_list, cell_y_list = [np.zeros((0, 4), dtype=np.int64)], [np.zeros((0, 4), dtype=np.int64)]
+    reachability = None if enforce_gravity else Reachability(board, ~blocked)
+    for piece_id in piece_order:
+        for rotation_id, orientation in enumerate(orientation_table[piece_id]):
+            dx, dy = _orientation_offsets[piece_id][rotation_id]
+            if reachability is not None:
+                xs, ys = reachability.anchors((piece_id, rotation_id))
+            else:
+                min_dx, max_dx, _, max_dy = orientation.extents
+                start_height = orientation.spawn_height
+                if start_height + max_dy >= height:
+                    continue
+
+                # The piece must fit at its spawn height, and then falls until one of its cells would enter a blocked cell
+                xs = np.arange(-min_dx, width - max_dx)
+                start_rows = start_height + dy
+                below = next_blocked[xs[:, None] + dx, start_rows]
+                fits = np.all(below != start_rows, axis=1)
+                xs, ys = xs[fits], np.min(below[fits] - 1 - dy, axis=1)
+
+            piece_id_list.append(np.full(len(xs), piece_id))
+            rotation_id_list.append(np.full(len(xs), rotation_id))
+            x_list.append(xs)
+            y_list.append(ys)
+            cell_x_list.append(xs[:, None] + dx)
+            cell_y_list.append(ys[:, None] + dy)
+
+    anchors = np.stack([np.concatenate(x_list), np.concatenate(y_list)], axis=1)
+    return PlacementBatch(np.concatenate(piece_id_list), np.concatenate(rotation_id_list), anchors, np.concatenate(cell_x_list), np.concatenate(cell_y_list))
@@ -0,0 +1,265 @@
+import json
+import os
+import random
+from collections.abc import Callable
+from tetris_env import Board, SimulationResult, piece_ids
+from tetris_features import SearchState
+
+CHECKPOINT_VERSION = 1
+
+# One level of the search: the ordered placements of a board, and how far through them the search is.
+# While one of the placements is applied and its subtree is being searched, `change` holds the record to undo it with,
+#   and `num_solutions` holds the number of solutions found before the subtree was entered.
+class SearchFrame:
+    def __init__(self, placements: list, index=0):
+        self.placements = placements
+        self.index = index
+        self.change = None
+        self.num_solutions = 0
+
+
+# Depth-first search over placement sequences, using an explicit stack of frames instead of recursion.
+# Each solution is given to on_success as its list of placements, (shape, anchor); building its animation is left to the caller.
+# This explores placements in exactly the same order as the recursive search did (including its use of `random`),
+#   but can be suspended between any two steps, saved to a checkpoint file, and resumed later (in another process if needed).
+class SearchEngine:
+    def __init__(self, agent, orig_board: Board, on_success: Callable[[list], None], board: Board = None):
+        self.agent = agent
+        self.orig_board = orig_board
+        self.on_success = on_success
+        self.state = SearchState((orig_board if board is None else board).copy(), agent.features, agent.transposition_table)
+
+        # Time each feature separately when the agent is instrumented
+        if agent.stats is not None:
+            evaluator = self.state.evaluator
+            evaluator.column_functions = [agent.stats.timed(f"feature:{feature.__name__}", function) for feature, function in zip(agent.features, evaluator.column_functions)]
+        self.stack: list[SearchFrame] = []
+        self.sequence = []
+        self.result = SimulationResult.NOT_DONE
+        self.started = False
+        self.nodes_expanded = 0
+
+        # Most false negatives a board can have and be a solution. The agent's allowance is only used for pruning,
+        #   so this can be lower than it (see search_approximations).
+        self.allowable_false_negatives = agent.allowable_false_negatives
+
+        # (errors, placements) of the board reached with the fewest errors (false positives plus false negatives) so far, if any
+        self.best = None
+
+        # Number of placements at the start of the sequence that were applied before the search started (see from_task)
+        self.prefix_length = 0
+
+    # Builds an engine that only searches the given placements of the board reached by the given prefix of placements.
+    # This is used to search parts of the tree separately (see split).
+    @classmethod
+    def from_task(cls, agent, orig_board: Board, on_success: Callable[[list], None], prefix: list, placements: list):
+        engine = cls(agent, orig_board, on_success)
+        for shape, anchor in prefix:
+            engine.state.apply(shape, anchor, not agent.enforce_gravity)
+            engine.sequence.append((shape, anchor))
+        engine.prefix_length = len(prefix)
+        engine.started = True
+        if placements:
+            engine.stack.append(SearchFrame(placements))
+        return engine
+
+    @property
+    def finished(self):
+        return self.result != SimulationResult.NOT_DONE
+
+    # Evaluates the current board as a new node of the search.
+    # If it still needs placements and has some, a frame is pushed for them. Otherwise, the node's result is returned.
+    def _enter_node(self):
+        agent, state, stats = self.agent, self.state, self.agent.stats
+        self.nodes_expanded += 1
+        if stats is not None:
+            stats.nodes += 1
+
+        # Randomly order the pieces
+        piece_order = random.sample(piece_ids, len(piece_ids))
+
+        # Evaluate end condition
+        if agent.would_fail(state.num_false_positives, state.islands.num_stragglers, state.islands.num_islands):
+            if stats is not None:
+                stats.prune("would_fail")
+            return SimulationResult.FAILURE
+        if state.num_false_negatives <= self.allowable_false_negatives:
+            return SimulationResult.SUCCESS
+        if agent.prune_bounds and agent.cannot_succeed(state.board, state.num_false_positives, state.islands):
+            if stats is not None:
+                stats.prune("lower_bound")
+            return SimulationResult.FAILURE
+
+        # Determine the scores for all possible placements for all pieces (if there are none, the node fails)
+        placements = agent.get_all_scored_placements(state.board, piece_order, state.evaluator, state.islands)
+        if len(placements) == 0:
+            if stats is not None:
+                stats.prune("no_placements")
+            return SimulationResult.FAILURE
+
+        # Order the placements by score, but randomize the order of placements with the same score
+        self.stack.append(SearchFrame(agent.order_placements(placements)))
+        return SimulationResult.NOT_DONE
+
+    # Runs the search until it is finished or should_stop() returns True (checked between steps).
+    # Returns the result of the search, which is NOT_DONE if it was suspended.
+    def run(self, should_stop: Callable[[], bool] = None):
+        if not self.started:
+            self.started = True
+            self.result = self._enter_node()
+            if self.stack:
+                self.result = SimulationResult.NOT_DONE
+
+        while self.stack:
+            if should_stop is not None and should_stop():
+                return SimulationResult.NOT_DONE
+            self._step()
+
+        if not self.finished:
+            self.result = SimulationResult.FAILURE
+        return self.result
+
+    # Advances the search by one placement (or one backtrack)
+    def _step(self):
+        agent, state = self.agent, self.state
+        transposition_table = agent.transposition_table
+        frame = self.stack[-1]
+
+        # Returning from the subtree of the applied placement: if nothing was found in it, remember that its board fails, then undo it
+        if frame.change is not None:
+            if transposition_table is not None and agent.num_solutions == frame.num_solutions:
+                transposition_table.record_failure(state.hash)
+            self._undo(frame)
+
+        if frame.index >= len(frame.placements):
+            self.stack.pop()
+            return
+
+        # Put the next shape onto the board (make the placement)
+        _, shape, anchor = frame.placements[frame.index]
+        frame.index += 1
+        change = state.apply(shape, anchor, not agent.enforce_gravity)
+        self.sequence.append((shape, anchor))
+
+        # Re-evaluate end condition
+        result = SimulationResult.FAILURE if state.num_false_positives > agent.allowable_false_positives else SimulationResult.NOT_DONE if state.num_false_negatives > self.allowable_false_negatives else SimulationResult.SUCCESS
+
+        if result == SimulationResult.NOT_DONE and transposition_table is not None and transposition_table.is_failure(state.hash):
+            # This board has already been searched without success (through a different order of placements)
+            result = SimulationResult.FAILURE
+            if agent.stats is not None:
+                agent.stats.prune("transposition")
+
+        errors = state.num_false_positives + state.num_false_negatives
+        if self.best is None or errors < self.best[0]:
+            self.best = (errors, list(self.sequence))
+        if agent.stats is not None:
+            agent.stats.reached(len(self.sequence), errors)
+
+        if result == SimulationResult.NOT_DONE:
+            # Search the subtree of this placement. If the new node finishes immediately, it is handled as a return on the next step.
+            frame.change = change
+            frame.num_solutions = agent.num_solutions
+            self._enter_node()
+            return
+
+        # On success, trigger on_success function
+        if result == SimulationResult.SUCCESS:
+            agent.num_solutions += 1
+            self.on_success(list(self.sequence))
+
+        # Undo the placement before trying the next one
+        self.sequence.pop()
+        state.undo(change)
+
+    # Removes the untried placements of the shallowest frame that has any, and returns them as a task for from_task: (prefix, placements).
+    # Returns None if there are none.
+    def split(self):
+        for depth, frame in enumerate(self.stack):
+            if frame.index < len(frame.placements):
+                break
+        else:
+            return None
+
+        placements = frame.placements[frame.index:]
+        frame.placements = frame.placements[:frame.index]
+
+        # The subtrees leading to this frame are no longer searched in full here, so their boards must not be recorded as failures
+        for ancestor in self.stack[:depth]:
+            ancestor.num_solutions = -1
+        return self.sequence[:self.prefix_length + depth], placements
+
+    def _undo(self, frame: SearchFrame):
+        self.sequence.pop()
+        self.state.undo(frame.change)
+        frame.change = None
+
+    # Returns a JSON-serializable snapshot of the search, which resume() can continue from.
+    # The agent's transposition table is saved along with it (its hashes do not depend on the process), so a resumed search
+    #   does not have to search again the boards that had already failed.
+    def to_dict(self):
+        version, internal_state, gauss_next = random.getstate()
+        return {
+            "version": CHECKPOINT_VERSION,
+            "started": self.started,
+            "result": self.result.value,
+            "random_state": [version, list(internal_state), gauss_next],
+            "num_solutions": self.agent.num_solutions,
+            "nodes_expanded": self.nodes_expanded,
+            "prefix_length": self.prefix_length,
+            "sequence": [[*shape, *anchor] for shape, anchor in self.sequence],
+            "frames": [{
+                "placements": [[score, *shape, *anchor] for score, shape, anchor in frame.placements],
+                "index": frame.index,
+                "applied": frame.change is not None,
+                "num_solutions": frame.num_solutions,
+            } for frame in self.stack],
+            "transposition_table": None if self.agent.transposition_table is None else self.agent.transposition_table.snapshot(),
+        }
+
+    # Writes the snapshot to a file (atomically, so an interrupted write never leaves a broken checkpoint), along with any metadata
+    def save_checkpoint(self, path, metadata: dict = None):
+        data = {"metadata": metadata or {}, "search": self.to_dict()}
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_path, path)
+
+    # Builds an engine that continues the search described by a snapshot from to_dict()
+    @classmethod
+    def resume(cls, agent, orig_board: Board, on_success: Callable[[list], None], snapshot: dict):
+        if snapshot.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {snapshot.get('version')}")
+
+        engine = cls(agent, orig_board, on_success)
+        engine.started = snapshot["started"]
+        engine.result = SimulationResult(snapshot["result"])
+        engine.nodes_expanded = snapshot["nodes_expanded"]
+        agent.num_solutions = snapshot["num_solutions"]
+        version, internal_state, gauss_next = snapshot["random_state"]
+        random.setstate((version, tuple(internal_state), gauss_next))
+        if agent.transposition_table is not None and snapshot.get("transposition_table") is not None:
+            agent.transposition_table.restore(snapshot["transposition_table"])
+
+        for frame_data in snapshot["frames"]:
+            frame = SearchFrame([(score, (piece_id, rotation_id), (x, y)) for score, piece_id, rotation_id, x, y in frame_data["placements"]], frame_data["index"])
+            frame.num_solutions = frame_data["num_solutions"]
+            engine.stack.append(frame)
+
+        # Re-apply the current sequence of placements, giving each frame back the record of the placement it has applied
+        engine.prefix_length = snapshot.get("prefix_length", 0)
+        applied_frames = [None] * engine.prefix_length + [frame for frame, frame_data in zip(engine.stack, snapshot["frames"]) if frame_data["applied"]]
+        if len(applied_frames) != len(snapshot["sequence"]):
+            raise ValueError("Checkpoint sequence does not match its frames")
+        for frame, (piece_id, rotation_id, x, y) in zip(applied_frames, snapshot["sequence"]):
+            shape, anchor = (piece_id, rotation_id), (x, y)
+            change = engine.state.apply(shape, anchor, not agent.enforce_gravity)
+            if frame is not None:
+                frame.change = change
+            engine.sequence.append((shape, anchor))
+        return engine
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        with open(path) as file:
+            return json.load(file)
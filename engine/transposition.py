@@ -0,0 +1,79 @@
+import numpy as np
+from collections import OrderedDict
+from tetris_env import Board
+from utils import log
+
+# Number of lookups between each hit/miss statistics log
+LOG_INTERVAL = 100000
+
+# Remembers settled boards whose whole subtree has already been searched without finding a solution,
+#   so that reaching the same board through a different order of placements does not search it again.
+# Boards are identified by a Zobrist hash: the XOR of a fixed random key for the value of every cell.
+# Placing a piece only changes the values of its cells, so the hash of the next board is found by XORing out their old keys and XORing in their new ones.
+# Only the cell values are hashed, since those alone determine how the rest of the search goes.
+# The table holds at most max_entries boards, and evicts the least recently used when full.
+# Its stats are logged along with log_fields (such as the job_id of the job it is searching for).
+class TranspositionTable:
+    # The keys are generated from a fixed seed, so every process gives the same board the same hash
+    SEED = 0x7e7f
+
+    def __init__(self, board_shape, max_entries=200000, log_fields: dict = None):
+        rng = np.random.default_rng(self.SEED)
+        self.keys = rng.integers(0, 2**63, size=(*board_shape, 5), dtype=np.uint64)
+        self.max_entries = max_entries
+        self.log_fields = log_fields or {}
+        self.failures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hash_board(self, board: Board):
+        x, y = np.indices(board.shape)
+        return int(np.bitwise_xor.reduce(self.keys[x, y, board.values], axis=None))
+
+    # Returns the hash of the board after the given cells have each been incremented by 1, given the hash of the board before
+    def hash_after(self, board_hash, board: Board, cells):
+        for x, y in cells:
+            value = board.values[x, y]
+            board_hash ^= int(self.keys[x, y, value]) ^ int(self.keys[x, y, value + 1])
+        return board_hash
+
+    # Returns True iff the board with the given hash is already known to fail
+    def is_failure(self, board_hash):
+        if board_hash in self.failures:
+            self.failures.move_to_end(board_hash)
+            self.hits += 1
+        else:
+            self.misses += 1
+        if (self.hits + self.misses) % LOG_INTERVAL == 0:
+            self.log_stats()
+        return board_hash in self.failures
+
+    def record_failure(self, board_hash):
+        self.failures[board_hash] = True
+        self.failures.move_to_end(board_hash)
+        if len(self.failures) > self.max_entries:
+            self.failures.popitem(last=False)
+            self.evictions += 1
+
+    # Returns the hashes of the boards known to fail, least recently used first (to be saved with a checkpoint of the search)
+    def snapshot(self):
+        return list(self.failures)
+
+    # Replaces the boards known to fail with those of a snapshot (keeping the most recently used, if there are more than max_entries)
+    def restore(self, hashes: list):
+        self.failures = OrderedDict((board_hash, True) for board_hash in hashes[max(0, len(hashes) - self.max_entries):])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.failures),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        log(f"Transposition table: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), {stats['entries']} entries, {stats['evictions']} evictions", **self.log_fields)
@@ -0,0 +1,135 @@
+import sys, time, random, argparse, statistics
+import multiprocessing as mp
+from collections.abc import Callable
+from benchmark import TARGETS, target_grid, random_target_grid
+
+# Tunes the feature weights (TetrisAgent.parameters) of one configuration of the agent, and saves them as its profile (see weight_profiles).
+# The weights decide the order placements are tried in, so they are scored by how quickly seeded searches find their first solution
+#   on a corpus of targets: the median number of nodes expanded (which does not depend on the machine), then the median time.
+# A search that finds no solution within its limits counts as UNSOLVED_PENALTY times the node limit.
+# Since the times are noisy, each solved search is timed over several runs (keeping the fastest), and weights with the same median nodes
+#   as the best so far only replace them if their median time is faster by more than a margin (see is_better).
+#
+#   python tune_weights.py [--gravity 0|1] [--reduce-Is 0|1] [--false-positives N] [--false-negatives N] [--method random|coordinate]
+#                          [--iterations N] [--targets ...] [--random N] [--timing-runs N] [--time-margin M] [--output file]
+#
+# Random search tries weights drawn around the best so far (with a shrinking spread); coordinate descent changes one weight at a time,
+#   halving its step whenever a whole pass over the weights does not improve on the best.
+# Each set of weights is evaluated on every case (target and seed) in parallel, with one process per core.
+
+# Multiple of the node limit that an unsolved search counts as
+UNSOLVED_PENALTY = 2
+
+# Runs one seeded search until its first solution (or the node or time limit), and returns its node count, its time, and whether it was solved.
+# A solved search is run timing_runs times in all (expanding the same nodes each time, since it has the same seed), and its fastest time is returned.
+def _evaluate_case(grid, options, parameters, seed, max_nodes, time_limit, timing_runs=1):
+    from tetris_env import board_from_grid
+    from tetris_agent import TetrisAgent
+    from tetris_search import SearchEngine
+
+    board = board_from_grid(grid)
+    best_seconds = None
+    for _ in range(timing_runs):
+        agent = TetrisAgent(board.shape, *options, parameters=parameters)
+        solved = []
+        random.seed(seed)
+        start = time.perf_counter()
+        engine = SearchEngine(agent, board, lambda placements: solved.append(True))
+        engine.run(should_stop=lambda: solved or engine.nodes_expanded >= max_nodes or time.perf_counter() - start >= time_limit)
+        seconds = time.perf_counter() - start
+        best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+        if not solved:
+            break
+    return engine.nodes_expanded, best_seconds, bool(solved)
+
+# Returns the score of the weights over every case (lower is better): (median nodes, median seconds), along with the number of cases solved
+def evaluate(pool, cases, options, parameters, args):
+    results = pool.starmap(_evaluate_case, [(grid, options, parameters, seed, args.max_nodes, args.time_limit, args.timing_runs) for grid, seed in cases])
+    nodes = [nodes if solved else UNSOLVED_PENALTY * args.max_nodes for nodes, _, solved in results]
+    seconds = [seconds if solved else UNSOLVED_PENALTY * args.time_limit for _, seconds, solved in results]
+    return (statistics.median(nodes), statistics.median(seconds)), sum(solved for _, _, solved in results)
+
+# Returns whether a score is better than the best so far: it must expand fewer median nodes, or as many in a median time that is
+#   faster by more than the given fraction of the best time (so that timing noise alone never decides between two sets of weights)
+def is_better(score, best_score, time_margin):
+    nodes, seconds = score
+    best_nodes, best_seconds = best_score
+    return nodes < best_nodes or (nodes == best_nodes and seconds < best_seconds * (1 - time_margin))
+
+# Yield the weights to try next, given a function that returns the best weights so far (which may change after each one is tried)
+def random_candidates(rng: random.Random, best: Callable[[], list], iterations):
+    for iteration in range(iterations):
+        spread = 1 - iteration / iterations
+        yield [weight + rng.uniform(-spread, spread) for weight in best()]
+
+def coordinate_candidates(best: Callable[[], list], iterations, step=0.5):
+    tried = 0
+    while tried < iterations:
+        improved = False
+        for i in range(len(best())):
+            for direction in (1, -1):
+                if tried >= iterations:
+                    return
+                start = best()
+                candidate = [*start]
+                candidate[i] += direction * step
+                tried += 1
+                yield candidate
+                if best() != start:
+                    improved = True
+                    break
+        if not improved:
+            step /= 2
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the feature weights of the Tetrify agent")
+    parser.add_argument("--gravity", type=int, choices=[0, 1], default=1)
+    parser.add_argument("--reduce-Is", type=int, choices=[0, 1], default=1)
+    parser.add_argument("--false-positives", type=int, default=0)
+    parser.add_argument("--false-negatives", type=int, default=0)
+    parser.add_argument("--method", choices=["random", "coordinate"], default="coordinate")
+    parser.add_argument("--iterations", type=int, default=40, help="Number of weight vectors to try")
+    parser.add_argument("--targets", nargs="*", choices=list(TARGETS), help="Benchmark targets in the corpus (all by default)")
+    parser.add_argument("--random", type=int, default=0, help="Number of random (reachable) targets to add to the corpus")
+    parser.add_argument("--seeds", type=int, default=3, help="Seeded searches per target")
+    parser.add_argument("--max-nodes", type=int, default=2000, help="Nodes after which a search counts as unsolved")
+    parser.add_argument("--time-limit", type=float, default=20, help="Seconds after which a search counts as unsolved")
+    parser.add_argument("--timing-runs", type=int, default=3, help="Runs of each solved search, of which the fastest is its time")
+    parser.add_argument("--time-margin", type=float, default=0.1, help="Fraction by which the median time must improve to accept weights with the same median nodes")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes (the number of cores by default)")
+    parser.add_argument("--output", default=None, help="Profiles file to save the tuned weights to (weight_profiles.PROFILES_PATH by default)")
+    args = parser.parse_args()
+
+    from tetris_agent import agent_features
+    from weight_profiles import PROFILES_PATH, load_parameters, save_parameters
+
+    features = agent_features(args.reduce_Is)
+    options = (args.false_positives, args.false_negatives, bool(args.gravity), bool(args.reduce_Is))
+    output = args.output or PROFILES_PATH
+
+    grids = [target_grid(name) for name in args.targets or list(TARGETS)]
+    rng = random.Random(0)
+    grids += [random_target_grid(rng, 8, 5, 6) for _ in range(args.random)]
+    cases = [(grid, seed) for grid in grids for seed in range(args.seeds)]
+
+    with mp.get_context("spawn").Pool(args.processes) as pool:
+        # Start from the saved profile, if there is one
+        best = load_parameters(features, args.false_positives, args.false_negatives, args.gravity, args.reduce_Is, output) or [-1.0 for _ in features]
+        best_score, best_solved = evaluate(pool, cases, options, best, args)
+        initial_score = best_score
+        print(f"Start {best}: {best_score[0]:.0f} nodes, {best_score[1]:.3f}s, {best_solved}/{len(cases)} solved", file=sys.stderr)
+
+        candidates = random_candidates(rng, lambda: best, args.iterations) if args.method == "random" else coordinate_candidates(lambda: best, args.iterations)
+        for candidate in candidates:
+            score, solved = evaluate(pool, cases, options, candidate, args)
+            better = is_better(score, best_score, args.time_margin)
+            print(f"{'*' if better else ' '} {[round(weight, 3) for weight in candidate]}: {score[0]:.0f} nodes, {score[1]:.3f}s, {solved}/{len(cases)} solved", file=sys.stderr)
+            if better:
+                best, best_score, best_solved = candidate, score, solved
+
+    save_parameters(features, best, args.false_positives, args.false_negatives, args.gravity, args.reduce_Is, output, median_nodes=best_score[0], median_seconds=best_score[1],
+                    solved=best_solved, cases=len(cases), initial_median_nodes=initial_score[0], method=args.method, tuned=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    print(f"Saved {best} to {output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
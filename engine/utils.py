@@ -1,11 +1,25 @@
+import os
 import json
+import threading
 
 EOF = "<EOF>"
 
-def log(*values):
-    data = {}
+# Messages may be sent from more than one thread, but each one must be written whole
+_send_lock = threading.Lock()
+
+# A forked process only has the thread that forked it, so the lock must not stay held by one of the others
+def _reset_send_lock():
+    global _send_lock
+    _send_lock = threading.Lock()
+os.register_at_fork(after_in_child=_reset_send_lock)
+
+# Sends the values as a log message, along with any other fields (such as the job_id of the job it is about)
+def log(*values, **fields):
+    data = {**fields}
     data["log"] = " ".join([str(val) for val in values])
-    print(json.dumps(data) + EOF, flush=True)
+    send(data)
 
 def send(json_msg):
-    print(json.dumps(json_msg) + EOF, flush=True)
\ No newline at end of file
+    message = json.dumps(json_msg) + EOF
+    with _send_lock:
+        print(message, flush=True)
\ No newline at end of file
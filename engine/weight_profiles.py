@@ -0,0 +1,45 @@
+import os
+import json
+
+# Tuned feature weights (made by tune_weights), which the driver uses for jobs that do not give their own "parameters"
+PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weight_profiles.json")
+
+# Each profile is for one configuration of the agent, since the features (and the best weights for them) depend on it
+def profile_key(allowable_false_positives, allowable_false_negatives, enforce_gravity, reduce_Is):
+    return f"gravity={int(bool(enforce_gravity))},reduce_Is={int(bool(reduce_Is))},false_positives={int(allowable_false_positives)},false_negatives={int(allowable_false_negatives)}"
+
+# Returns the configuration of a profile key as a dict of ints (keys from before the allowances were added to them are for no allowances)
+def key_options(key):
+    options = {"false_positives": 0, "false_negatives": 0}
+    options.update((name, int(value)) for name, value in (option.split("=") for option in key.split(",")))
+    return options
+
+def load_profiles(path=PROFILES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+# Returns the tuned parameters for the configuration, or None if there are none (or they were tuned for other features).
+# Without a profile for the exact allowances, the profile with the same gravity and reduce_Is whose allowances are nearest is used.
+def load_parameters(features: list, allowable_false_positives, allowable_false_negatives, enforce_gravity, reduce_Is, path=PROFILES_PATH):
+    names = [feature.__name__ for feature in features]
+    wanted = key_options(profile_key(allowable_false_positives, allowable_false_negatives, enforce_gravity, reduce_Is))
+    candidates = []
+    for key, profile in load_profiles(path).items():
+        options = key_options(key)
+        if profile["features"] == names and options["gravity"] == wanted["gravity"] and options["reduce_Is"] == wanted["reduce_Is"]:
+            distance = abs(options["false_positives"] - wanted["false_positives"]) + abs(options["false_negatives"] - wanted["false_negatives"])
+            candidates.append((distance, key, profile["parameters"]))
+    if not candidates:
+        return None
+    return min(candidates)[2]
+
+# Saves the parameters as the profile of the configuration, keeping the profiles of every other configuration
+def save_parameters(features: list, parameters: list, allowable_false_positives, allowable_false_negatives, enforce_gravity, reduce_Is, path=PROFILES_PATH, **details):
+    profiles = load_profiles(path)
+    profiles[profile_key(allowable_false_positives, allowable_false_negatives, enforce_gravity, reduce_Is)] = {"features": [feature.__name__ for feature in features], "parameters": list(parameters), **details}
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(profiles, file, indent=2)
+    os.replace(temp_path, path)
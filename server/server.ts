@@ -1,9 +1,8 @@
 import { WebSocketServer, WebSocket } from 'ws';
-import { ChildProcess } from 'child_process';
 import { _runEngine, _stopEngine } from '../engine/tetrifyEngine.cjs'
 
-//Define a WebSocket wrapper type that includes a reference to child processes
-type TetrifyWebSocket = WebSocket & { children: ChildProcess[] | undefined }
+//Define a WebSocket wrapper type that includes a reference to its engine job
+type TetrifyWebSocket = WebSocket & { job: { id: number, kill: () => void } | undefined }
 
 const TIMEOUT_MILLIS = 300000;
 const PING_INTERVAL = 20000;
@@ -25,8 +24,8 @@ wsServer.on('connection', (ws: TetrifyWebSocket) => {
                 throw new Error("All properties must be defined.");
             }
 
-            //Start the engine and store reference to children
-            ws.children = _runEngine(
+            //Start the engine (the job waits in the engine's queue if all of its workers are busy) and store reference to the job
+            ws.job = _runEngine(
                 data["grid"],
                 data["false_positives"],
                 data["false_negatives"],
@@ -34,12 +33,16 @@ wsServer.on('connection', (ws: TetrifyWebSocket) => {
                 data["reduce_Is"],
                 (frames) => { ws.send(JSON.stringify({ frames: frames })); },    //When an animation is found, send the frames
                 () => { ws.close(); },       //When simulation ends, close the websocket
-                1       //Use only one thread
+                1,      //Use only one thread
+                TIMEOUT_MILLIS / 1000,      //Stop the job when the session times out, even if the socket fails to close
+                (message) => { ws.send(JSON.stringify(message)); },     //Pass compact animations on as they are (the client decodes them)
+                (stats) => { ws.send(JSON.stringify({ stats: stats })); },      //Pass search statistics on
+                data["anytime_seconds"],       //Send approximations if the client asked for them (and no exact solution was found in time)
+                (frames) => { ws.send(JSON.stringify({ frames: frames, approximate: true })); }     //Send approximations flagged as such
             );
 
-            let pids = ws.children.map((child) => child.pid)
-            console.log("Children:", JSON.stringify(pids));
-            ws.send(JSON.stringify({log: pids}))
+            console.log("Job:", ws.job.id);
+            ws.send(JSON.stringify({log: `Job ${ws.job.id}`}))
 
             //After timeout, cut off the session by closing websocket
             setTimeout(() => {
@@ -60,16 +63,16 @@ wsServer.on('connection', (ws: TetrifyWebSocket) => {
         }
     }
 
-    //Kill this session's child processes when its web socket is closed
+    //Stop this session's job when its web socket is closed
     ws.onclose = (event) => {
         console.log("Connection closed")
-        if (ws.children) {
-            ws.children.forEach((child) => child.kill())
+        if (ws.job) {
+            ws.job.kill()
         }
     }
 });
 
-// When server closes, stop *all* children (across all sessions)
+// When server closes, stop *all* jobs (across all sessions)
 wsServer.on('close', () => {
     console.log("Server closed.");
     _stopEngine();